@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+""" Load test dkrserver against the fake docker engine, reports throughput, p50/p99 latency
+    and docker API calls per request for each endpoint and serving mode
+
+    # python bench/bench.py --containers 10 1000 10000 --clients 8 --requests 25
+    # python bench/bench.py --containers 1000 --latency create=0.5 start=1.0 --mode asgi
+    # python bench/bench.py --containers 1000 --hosts 4
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import http.client
+import socketserver
+from pathlib import Path
+from wsgiref import simple_server
+from yaml import safe_load, safe_dump
+
+from fakedocker import FakeEngine
+
+REPODIR = Path(__file__).resolve().parent.parent
+
+
+class _ThreadingWSGIServer(socketserver.ThreadingMixIn, simple_server.WSGIServer):
+    daemon_threads = True
+
+
+class _QuietHandler(simple_server.WSGIRequestHandler):
+    def log_message(self, *args):
+        return
+
+
+def _serve_wsgi(app):
+    ''' Threaded wsgiref server on a free port, returns (port, stop function) '''
+    httpd = simple_server.make_server('127.0.0.1', 0, app, server_class=_ThreadingWSGIServer,
+                                      handler_class=_QuietHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    def stop():
+        httpd.shutdown()
+        httpd.server_close()
+    return httpd.server_port, stop
+
+
+def _serve_asgi(app):
+    ''' uvicorn server on a free port, returns (port, stop function) '''
+    import socket
+    import uvicorn
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    server = uvicorn.Server(uvicorn.Config(app, log_level='warning', lifespan='off'))
+    thr = threading.Thread(target=server.run, kwargs={'sockets': [sock]}, daemon=True)
+    thr.start()
+    while not server.started:
+        time.sleep(0.05)
+    def stop():
+        server.should_exit = True
+        thr.join()
+        sock.close()
+    return sock.getsockname()[1], stop
+
+
+def _call(port, method, path, user, body=None):
+    ''' Single request on a new connection, returns (status, seconds, decoded body) '''
+    headers = {'username': user, 'Content-Type': 'application/json'}
+    data = json.dumps(body) if body is not None else None
+    start = time.perf_counter()
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+    try:
+        conn.request(method, path, body=data, headers=headers)
+        resp = conn.getresponse()
+        payload = resp.read()
+        status = resp.status
+    finally:
+        conn.close()
+    elapsed = time.perf_counter() - start
+    try:
+        payload = json.loads(payload or b'null')
+    except ValueError:
+        pass
+    return status, elapsed, payload
+
+
+def _pct(samples, pct):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(pct * (len(samples) - 1))))]
+
+
+def _calls(engines):
+    return sum(engine.total_calls() for engine in engines)
+
+
+def _phase(engines, port, name, clients, requests, reqfunc):
+    ''' Run reqfunc(client, indx) -> (method, path, user, body) from concurrent clients.
+        Returns a result row for the report
+    '''
+    lock = threading.Lock()
+    times = []
+    errors = {}
+
+    def client(cindx):
+        for indx in range(requests):
+            method, path, user, body = reqfunc(cindx, indx)
+            try:
+                status, elapsed, _ = _call(port, method, path, user, body)
+            except OSError as err:
+                status, elapsed = type(err).__name__, 0
+            with lock:
+                times.append(elapsed)
+                if not f"{status}".startswith('2'):
+                    errors[status] = errors.get(status, 0) + 1
+
+    calls = _calls(engines)
+    start = time.perf_counter()
+    thrds = [threading.Thread(target=client, args=(cindx,)) for cindx in range(clients)]
+    for thr in thrds:
+        thr.start()
+    for thr in thrds:
+        thr.join()
+    wall = time.perf_counter() - start
+    total = clients * requests
+    return {'phase': name,
+            'requests': total,
+            'errors': sum(errors.values()),
+            'status': errors,
+            'rps': total / wall if wall else 0.0,
+            'p50': _pct(times, 0.50) * 1000,
+            'p99': _pct(times, 0.99) * 1000,
+            'calls': (_calls(engines) - calls) / total if total else 0.0}
+
+
+def _loaduser(cindx, indx, mode):
+    return f"load{mode}{cindx:03d}n{indx:05d}u"
+
+
+def run_mode(engines, seeded, mode, serve, clients, requests, image):
+    ''' All phases against one serving mode, each launch uses its own user to stay under MAX_PER_USER '''
+    port, stop = serve()
+    launch = {'image': image, 'remove': False}
+    rows = []
+    try:
+        rows.append(_phase(engines, port, 'GET /containers', clients, requests,
+                           lambda c, i: ('GET', '/containers', f"bench{(c*requests + i) % seeded:04d}u", None)))
+        rows.append(_phase(engines, port, 'GET /images', clients, requests,
+                           lambda c, i: ('GET', '/images', 'system', None)))
+        rows.append(_phase(engines, port, 'POST /containers', clients, requests,
+                           lambda c, i: ('POST', '/containers', _loaduser(c, i, mode), launch)))
+        for action in ('stop', 'start'):
+            rows.append(_phase(engines, port, f"PUT /containers {action}", clients, requests,
+                               lambda c, i, a=action: ('PUT', '/containers', _loaduser(c, i, mode),
+                                                       {'action': a,
+                                                        'container name': _loaduser(c, i, mode)})))
+        rows.append(_phase(engines, port, 'DELETE /containers', clients, requests,
+                           lambda c, i: ('DELETE', '/containers', _loaduser(c, i, mode),
+                                         {'container name': _loaduser(c, i, mode)})))
+    finally:
+        stop()
+    return rows
+
+
+def _report(title, rows, out):
+    out.write(f"\n{title}\n")
+    out.write(f"{'phase':<26}{'requests':>9}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}"
+              f"{'docker calls/req':>18}\n")
+    for row in rows:
+        out.write(f"{row['phase']:<26}{row['requests']:>9}{row['errors']:>8}{row['rps']:>10.1f}"
+                  f"{row['p50']:>10.1f}{row['p99']:>10.1f}{row['calls']:>18.2f}\n")
+        if row['status']:
+            out.write(f"{'':<26}non 2xx: {row['status']}\n")
+    out.flush()
+
+
+def _latency(pairs):
+    latency = {}
+    for pair in pairs or []:
+        key, _, val = pair.partition('=')
+        latency[key] = float(val)
+    return latency
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--containers', type=int, nargs='+', default=[10, 1000, 10000],
+                        help='seeded container counts, one run per count (default: 10 1000 10000)')
+    parser.add_argument('--images', type=int, default=None,
+                        help='seeded image count (default: same as containers)')
+    parser.add_argument('--users', type=int, default=None,
+                        help='users the seeded containers are spread over (default: containers/3)')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent clients (default: 8)')
+    parser.add_argument('--requests', type=int, default=25, help='requests per client per phase (default: 25)')
+    parser.add_argument('--latency', nargs='*', metavar='CALL=SECONDS',
+                        help='docker call latency, e.g. create=0.5 start=1.0')
+    parser.add_argument('--hosts', type=int, default=1,
+                        help='fake docker engines, seeded containers are split across them (default: 1)')
+    parser.add_argument('--mode', choices=('wsgi', 'asgi', 'both'), default='both')
+    parser.add_argument('--image', default=None, help='image to launch (default: DEFAULTIMG)')
+    parser.add_argument('--set', nargs='*', metavar='KEY=VALUE', default=[],
+                        help='config.yml overrides, values are yaml, e.g. WARMPOOL=4')
+    parser.add_argument('--output', default=None, help='also append the report to this file')
+    args = parser.parse_args()
+
+    with open(REPODIR / 'config.yml') as yml:
+        cfg = safe_load(yml)
+    launches = args.clients * args.requests
+    # room for every launch of the default image and host capacity for every container, quiet logging
+    hostcpu = max(args.containers) + 2*launches + 16
+    cfg.update(LOGLEVEL='ERROR', MINPRT=20000, MAXPRT=20000 + 2*launches + 16,
+               HOSTCPU=hostcpu, HOSTMEM=f"{hostcpu}g",
+               DKRPOOLSIZE=max(cfg['DKRPOOLSIZE'], args.clients + 4))
+    for pair in args.set:
+        key, _, val = pair.partition('=')
+        cfg[key] = safe_load(val)
+
+    outs = [sys.stdout]
+    if args.output:
+        outs.append(open(args.output, 'a'))
+    workdir = tempfile.mkdtemp(prefix='dkrbench')
+    try:
+        with open(f"{workdir}/config.yml", 'w') as yml:
+            safe_dump(cfg, yml)
+        for count in args.containers:
+            users = args.users or max(1, count // cfg['MAX_PER_USER'])
+            images = count if args.images is None else args.images
+            engines = []
+            for indx in range(args.hosts):
+                first, last = count*indx // args.hosts, count*(indx + 1) // args.hosts
+                engine = FakeEngine(f"{workdir}/docker{count}h{indx}.sock", containers=last - first,
+                                    images=images, users=users, defaultimg=cfg['DEFAULTIMG'], seedfrom=first)
+                engine.start()
+                engines.append(engine)
+            os.environ['DOCKER_HOST'] = engines[0].url
+            seeded = max(1, min(users, count))
+            if args.hosts > 1:
+                # loopback aliases as host names, each host gets its own name in the application urls
+                hostcfg = [{'url': engine.url, 'host': f"127.0.0.{indx + 1}"} for indx, engine in enumerate(engines)]
+                with open(f"{workdir}/config.yml", 'w') as yml:
+                    safe_dump(dict(cfg, DKRHOSTS=hostcfg), yml)
+            cwd = os.getcwd()
+            os.chdir(workdir)
+            sys.path.insert(0, str(REPODIR))
+            try:
+                start = time.perf_counter()
+                sys.modules.pop('dkrserver', None)
+                import dkrserver
+                startup = time.perf_counter() - start
+                # measured calls exclude the startup container list
+                latency = _latency(args.latency)
+                for engine in engines:
+                    engine.latency = latency
+                modes = {'wsgi': lambda: _serve_wsgi(dkrserver.app),
+                         'asgi': lambda: _serve_asgi(dkrserver.asgiapp)}
+                if args.mode != 'both':
+                    modes = {args.mode: modes[args.mode]}
+                for mode, serve in modes.items():
+                    rows = run_mode(engines, seeded, mode, serve, args.clients, args.requests,
+                                    args.image or cfg['DEFAULTIMG'])
+                    for out in outs:
+                        _report(f"{mode.upper()}: {count} containers on {args.hosts} host(s), {images} images, "
+                                f"{users} users, {args.clients} clients x {args.requests} requests, "
+                                f"latency {latency or 'none'}, startup {startup:.2f}s", rows, out)
+            finally:
+                os.chdir(cwd)
+                sys.path.remove(str(REPODIR))
+                for engine in engines:
+                    engine.stop()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        for out in outs[1:]:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
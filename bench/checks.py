@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+""" Regression checks of dkrserver against the fake docker engine, each check prints ok or FAIL
+    with the reason, the exit status is the number of failed checks
+
+    # python bench/checks.py
+"""
+
+import io
+import os
+import atexit
+import sys
+import json
+import logging
+import shutil
+import tempfile
+from pathlib import Path
+from yaml import safe_load, safe_dump
+
+from falcon import testing
+
+from fakedocker import FakeEngine
+
+REPODIR = Path(__file__).resolve().parent.parent
+
+
+def _headers(user):
+    return {'username': user, 'Content-Type': 'application/json'}
+
+
+def _seed(engine):
+    ''' Containers the checks run against, added before dkrserver loads the container cache '''
+    # two containers of bob sharing the id prefix abcd
+    engine.addcontainer('bob', 'cdp_ml:v1', owner='bob', running=True, cid='abcd1111' + 'a'*56)
+    engine.addcontainer('bob1', 'cdp_ml:v1', owner='bob', running=True, cid='abcd2222' + 'b'*56)
+    # unlabelled containers launched before the owner label
+    engine.addcontainer('alice', 'cdp_ml:v1', running=True)
+    engine.addcontainer('alice1', 'cdp_ml:v1')
+    engine.addcontainer('bobby', 'cdp_ml:v1', running=True)
+
+
+def check_bulk_ambiguous(engine, client):
+    ''' A bulk id prefix matching more than one container is refused, as for a single container action '''
+    resp = client.simulate_post('/containers/bulk', headers=_headers('bob'),
+                                json={'action': 'stop', 'containers': ['abcd']})
+    result = resp.json['Bulk stop'][0]
+    assert result['status'] == '412 Precondition Failed', f"ambiguous prefix matched: {result}"
+    assert engine.cntrs['abcd1111' + 'a'*56]['State']['Running'], "container stopped"
+    resp = client.simulate_put('/containers', headers=_headers('bob'),
+                               json={'action': 'stop', 'container id': 'abcd'})
+    assert resp.status_code == 412, f"single action matched: {resp.status}"
+    resp = client.simulate_post('/containers/bulk', headers=_headers('bob'),
+                                json={'action': 'stop', 'containers': ['abcd2', 'bob']})
+    assert [each['status'] for each in resp.json['Bulk stop']] == ['200 OK']*2, resp.json
+
+
+def check_loglevel(engine, client):
+    ''' loglevel in the body is a level name or one of the standard level numbers, anything else is ignored '''
+    import dkrserver # pylint: disable=import-outside-toplevel
+    for loglevel, expected in (('debug', 10), (20, 20), ({'a': 1}, None), (['info'], None), (15, None),
+                               (True, None), (20.0, None), ('verbose', None)):
+        req = testing.create_req(headers=_headers('bob'))
+        req.context.doc = {'loglevel': loglevel}
+        dkrserver._reqcontext(req) # pylint: disable=protected-access
+        assert req.context.lgr.extra['loglevel'] == expected, f"loglevel {loglevel!r}: {req.context.lgr.extra}"
+    resp = client.simulate_get('/containers', headers=_headers('bob'), json={'loglevel': {'a': 1}})
+    assert resp.status_code == 200, f"dict loglevel: {resp.status}"
+
+
+def check_legacy_owner(engine, client):
+    ''' Unlabelled containers belong to the user by exact name, count toward MAX_PER_USER and can be removed '''
+    names = lambda user: sorted(each['container name'] for each in
+                                client.simulate_get('/containers', headers=_headers(user)).json['Running Containers'])
+    assert names('alice') == ['alice', 'alice1'], names('alice')
+    assert names('bob') == ['bob', 'bob1'], names('bob')
+    resp = client.simulate_post('/containers', headers=_headers('alice'), json={})
+    assert resp.status_code == 201, f"launch: {resp.status}"
+    resp = client.simulate_post('/containers', headers=_headers('alice'), json={})
+    assert resp.status_code == 412, f"launch over MAX_PER_USER: {resp.status}"
+    resp = client.simulate_delete('/containers', headers=_headers('alice'), json={'container name': 'alice1'})
+    assert resp.status_code == 200, f"delete: {resp.status} {resp.text}"
+    assert names('alice') == ['alice', 'alice2'], names('alice')
+
+
+def check_queue_log_json(engine, client):
+    ''' In queue mode a JSON log record carries the traceback in exc, formatted by the listener thread '''
+    import dkrserver # pylint: disable=import-outside-toplevel
+    out = io.StringIO()
+    lgr = logging.getLogger('dkrchecks')
+    lgr.addHandler(logging.StreamHandler(out))
+    lgr.propagate = False
+    listener = dkrserver._logsetup(lgr, {'LOGFORMAT': 'json', 'LOGMODE': 'queue'}) # pylint: disable=protected-access
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        lgr.error("Failed %s", 'check', exc_info=True)
+    listener.stop()
+    atexit.unregister(listener.stop)
+    doc = json.loads(out.getvalue())
+    assert doc['msg'] == 'Failed check', doc
+    assert 'ValueError: boom' in doc.get('exc', ''), doc
+
+
+def main():
+    with open(REPODIR / 'config.yml') as yml:
+        cfg = safe_load(yml)
+    cfg.update(LOGLEVEL='ERROR', WARMPOOL=0, PREPULL=[], MAX_PER_USER=3)
+    workdir = tempfile.mkdtemp(prefix='dkrchecks')
+    engine = FakeEngine(f"{workdir}/docker.sock", defaultimg=cfg['DEFAULTIMG'])
+    _seed(engine)
+    engine.start()
+    cwd = os.getcwd()
+    failed = 0
+    try:
+        with open(f"{workdir}/config.yml", 'w') as yml:
+            safe_dump(cfg, yml)
+        os.environ['DOCKER_HOST'] = engine.url
+        os.chdir(workdir)
+        sys.path.insert(0, str(REPODIR))
+        import dkrserver # pylint: disable=import-outside-toplevel
+        client = testing.TestClient(dkrserver.app)
+        for name, check in globals().items():
+            if not name.startswith('check_'):
+                continue
+            try:
+                check(engine, client)
+            except AssertionError as err:
+                failed += 1
+                print(f"FAIL {name}: {err}")
+            else:
+                print(f"ok   {name}")
+    finally:
+        os.chdir(cwd)
+        engine.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return failed
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,544 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+""" Minimal stand-in for the Docker Engine API served over a unix socket """
+
+import os
+import re
+import json
+import time
+import uuid
+import queue
+import random
+import hashlib
+import threading
+import socketserver
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+def _now():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f000Z')
+
+
+class FakeEngine():
+    ''' In-memory container and image state, with call counters and injectable latency
+
+    Parameters
+    -----------
+    sockpath : str
+        unix socket path the engine listens on
+    containers : int
+        Number of containers to seed (default: 0)
+    images : int
+        Number of images to seed (default: 0)
+    users : int
+        Number of users seeded containers are spread over (default: 10)
+    latency : dict
+        Seconds of delay injected per call, e.g. {'create': 0.5, 'start': 1.0}
+    seedfrom : int
+        Index of the first seeded container, keeps seeded names unique across several engines (default: 0)
+    '''
+    def __init__(self, sockpath, containers=0, images=0, users=10, latency=None,
+                 defaultimg='cdp_ml:v1', seedfrom=0):
+        self.sockpath = sockpath
+        self.latency = latency or {}
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.cntrs = {}
+        self.names = {} # name: container id
+        self.imgs = {}
+        self.subscribers = []
+        self.server = None
+        self.addimage(defaultimg, size=3622*1024*1024)
+        for indx in range(images):
+            self.addimage(f"seed{indx}:latest")
+        for indx in range(seedfrom, seedfrom + containers):
+            user = f"bench{indx % users:04d}u"
+            seq = indx // users
+            self.addcontainer(f"{user}{seq or ''}", defaultimg, owner=user,
+                              running=indx % 2 == 0)
+
+    # ---- state helpers
+    def addimage(self, tag, size=None):
+        ''' Add an image to the engine '''
+        imgid = 'sha256:' + hashlib.sha256(tag.encode()).hexdigest()
+        self.imgs[imgid] = {'Id': imgid,
+                            'RepoTags': [tag],
+                            'Size': size or random.randint(50, 2000)*1024*1024,
+                            'Created': _now(),
+                            'LastTagTime': _now()}
+        return imgid
+
+    def findimage(self, ref):
+        ''' Get image attrs by tag or id '''
+        if ':' not in ref and not ref.startswith('sha256'):
+            ref = f"{ref}:latest"
+        for imgid, img in self.imgs.items():
+            if ref in img['RepoTags'] or imgid.startswith(ref) or imgid[7:].startswith(ref):
+                return img
+        return None
+
+    def addcontainer(self, name, image, cmd=None, owner=None, running=False, body=None, cid=None):
+        ''' Create a container from a create request body, cid to choose the container id '''
+        body = body or {}
+        hcfg = body.get('HostConfig', {})
+        cmd = cmd if cmd is not None else (body.get('Cmd') or ['start-process.sh'])
+        labels = body.get('Labels') or {}
+        if owner:
+            labels['dkruser.owner'] = owner
+        ports = {}
+        for key, val in (hcfg.get('PortBindings') or {}).items():
+            ports[key] = [{'HostIp': '0.0.0.0', 'HostPort': str(each.get('HostPort', ''))}
+                          for each in val]
+        cid = cid or uuid.uuid4().hex + uuid.uuid4().hex
+        mounts = [{'Type': 'bind', 'Source': each.get('Source'), 'Destination': each.get('Target'),
+                   'Mode': '', 'RW': not each.get('ReadOnly'), 'Propagation': 'rprivate'}
+                  for each in hcfg.get('Mounts') or []]
+        self.cntrs[cid] = {
+            'Id': cid,
+            'Name': f"/{name}",
+            'Created': _now(),
+            'Path': cmd[0] if cmd else '',
+            'Args': cmd[1:],
+            'Image': (self.findimage(image) or {}).get('Id', ''),
+            'State': {'Status': 'running' if running else 'created', 'Running': running,
+                      'StartedAt': _now() if running else '0001-01-01T00:00:00Z',
+                      'FinishedAt': '0001-01-01T00:00:00Z'},
+            'HostConfig': {'Memory': hcfg.get('Memory', 512*1024*1024),
+                           'NanoCpus': hcfg.get('NanoCpus', 1000000000),
+                           'NetworkMode': hcfg.get('NetworkMode', 'bridge'),
+                           'AutoRemove': hcfg.get('AutoRemove', False),
+                           'PortBindings': hcfg.get('PortBindings') or {}},
+            'Config': {'Image': image, 'Cmd': cmd, 'Labels': labels, 'Tty': True},
+            'NetworkSettings': {'Ports': ports},
+            'Mounts': mounts,
+            '_rx': 0, '_tx': 0, '_cpu': 0,
+        }
+        self.names[name] = cid
+        return cid
+
+    def _find(self, ref):
+        cntr = self.cntrs.get(ref) or self.cntrs.get(self.names.get(ref, ''))
+        if cntr is None:
+            for cid, each in list(self.cntrs.items()):
+                if cid.startswith(ref):
+                    return each
+        return cntr
+
+    def _drop(self, cntr):
+        with self.lock:
+            self.cntrs.pop(cntr['Id'], None)
+            self.names.pop(cntr['Name'][1:], None)
+
+    def _public(self, cntr):
+        return {k: v for k, v in cntr.items() if not k.startswith('_')}
+
+    def _summary(self, cntr):
+        return {'Id': cntr['Id'], 'Names': [cntr['Name']], 'Image': cntr['Config']['Image'],
+                'Command': ' '.join(cntr['Config']['Cmd'] or []), 'Created': int(time.time()),
+                'State': cntr['State']['Status'], 'Status': cntr['State']['Status'],
+                'Labels': cntr['Config']['Labels']}
+
+    def emit(self, cntr, action, **attrs):
+        ''' Push an event to every /events subscriber '''
+        attributes = {'name': cntr['Name'][1:], 'image': cntr['Config']['Image']}
+        attributes.update(cntr['Config']['Labels'])
+        attributes.update(attrs)
+        evt = {'Type': 'container', 'Action': action, 'status': action, 'id': cntr['Id'],
+               'Actor': {'ID': cntr['Id'], 'Attributes': attributes},
+               'time': int(time.time()), 'timeNano': time.time_ns()}
+        for sub in list(self.subscribers):
+            sub.put(evt)
+
+    def emitimage(self, imgid, action, ref):
+        ''' Push an image event to every /events subscriber '''
+        evt = {'Type': 'image', 'Action': action, 'status': action, 'id': ref,
+               'Actor': {'ID': imgid, 'Attributes': {'name': ref}},
+               'time': int(time.time()), 'timeNano': time.time_ns()}
+        for sub in list(self.subscribers):
+            sub.put(evt)
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        delay = self.latency.get(name)
+        if delay:
+            time.sleep(delay)
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    # ---- serving
+    def start(self):
+        ''' Serve the engine API on the unix socket in a background thread '''
+        if os.path.exists(self.sockpath):
+            os.unlink(self.sockpath)
+        engine = self
+
+        class Handler(_Handler):
+            eng = engine
+
+        self.server = _Server(self.sockpath, Handler)
+        thr = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thr.start()
+        return self
+
+    def stop(self):
+        ''' Stop serving and drop the socket '''
+        for sub in list(self.subscribers):
+            sub.put(None)
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        if os.path.exists(self.sockpath):
+            os.unlink(self.sockpath)
+
+    @property
+    def url(self):
+        return f"unix://{self.sockpath}"
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    eng = None
+
+    def address_string(self):
+        return 'unix'
+
+    def log_message(self, *args):
+        return
+
+    def _send(self, code, body=None):
+        data = b'' if body is None else json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def _stream_start(self, ctype='application/json'):
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            return json.loads(self.rfile.read(length) or b'{}')
+        return {}
+
+    def _route(self, method):
+        url = urlparse(self.path)
+        path = re.sub(r'^/v[0-9.]+', '', url.path)
+        qry = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        eng = self.eng
+        try:
+            handler, args = _dispatch(method, path)
+        except LookupError:
+            self._send(404, {'message': f"page not found {path}"})
+            return
+        # count start/stop/... individually rather than as one generic action
+        eng.count(args[-1] if handler is _Handler._action else handler.__name__.lstrip('_'))
+        handler(self, qry, *args)
+
+    def do_GET(self):
+        self._route('GET')
+
+    def do_POST(self):
+        self._route('POST')
+
+    def do_DELETE(self):
+        self._route('DELETE')
+
+    def do_HEAD(self):
+        self._route('HEAD')
+
+    # ---- system
+    def _ping(self, qry):
+        self._send(200, 'OK')
+
+    def _version(self, qry):
+        self._send(200, {'Version': '24.0.0', 'ApiVersion': '1.43', 'MinAPIVersion': '1.12',
+                         'Os': 'linux', 'Arch': 'amd64'})
+
+    def _info(self, qry):
+        self._send(200, {'Containers': len(self.eng.cntrs), 'Images': len(self.eng.imgs),
+                         'NCPU': 16, 'MemTotal': 64*1024**3})
+
+    def _df(self, qry):
+        eng = self.eng
+        with eng.lock:
+            used = {c['Image'] for c in eng.cntrs.values()}
+            imgs = [{'Id': imgid, 'RepoTags': img['RepoTags'], 'Size': img['Size'], 'SharedSize': 0,
+                     'Created': int(time.time()), 'Containers': int(imgid in used)}
+                    for imgid, img in eng.imgs.items()]
+        self._send(200, {'LayersSize': sum(i['Size'] for i in imgs), 'Images': imgs,
+                         'Containers': [], 'Volumes': []})
+
+    def _events(self, qry):
+        sub = queue.Queue()
+        until = float(qry['until']) if qry.get('until') else None
+        self.eng.subscribers.append(sub)
+        self._stream_start()
+        try:
+            while until is None or time.time() < until:
+                try:
+                    evt = sub.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if evt is None:
+                    break
+                self._chunk(json.dumps(evt).encode() + b'\n')
+            self._chunk(b'')
+        except OSError:
+            pass
+        finally:
+            self.eng.subscribers.remove(sub)
+            self.close_connection = True
+
+    # ---- containers
+    def _containers_list(self, qry):
+        eng = self.eng
+        filters = json.loads(qry.get('filters', '{}'))
+        labels = filters.get('label', [])
+        if isinstance(labels, dict):
+            labels = [k for k, v in labels.items() if v]
+        with eng.lock:
+            lst = []
+            for cntr in eng.cntrs.values():
+                if qry.get('all') not in ('1', 'true', 'True') and not cntr['State']['Running']:
+                    continue
+                match = True
+                for lbl in labels:
+                    key, _, val = lbl.partition('=')
+                    if key not in cntr['Config']['Labels'] or \
+                       (val and cntr['Config']['Labels'][key] != val):
+                        match = False
+                if match:
+                    lst.append(eng._summary(cntr))
+        self._send(200, lst)
+
+    def _containers_inspect(self, qry, ref):
+        cntr = self.eng._find(ref)
+        if cntr is None:
+            self._send(404, {'message': f"No such container: {ref}"})
+        else:
+            self._send(200, self.eng._public(cntr))
+
+    def _create(self, qry):
+        eng = self.eng
+        body = self._body()
+        name = qry.get('name') or uuid.uuid4().hex[:8]
+        if eng.findimage(body.get('Image', '')) is None:
+            self._send(404, {'message': f"No such image: {body.get('Image')}"})
+            return
+        with eng.lock:
+            if name in eng.names:
+                self._send(409, {'message': f"Conflict. The container name \"/{name}\" is already in use"})
+                return
+            cid = eng.addcontainer(name, body['Image'], body=body)
+            cntr = eng.cntrs[cid]
+        eng.emit(cntr, 'create')
+        self._send(201, {'Id': cid, 'Warnings': []})
+
+    def _action(self, qry, ref, action):
+        eng = self.eng
+        cntr = eng._find(ref)
+        if cntr is None:
+            self._send(404, {'message': f"No such container: {ref}"})
+            return
+        state = cntr['State']
+        if action in ('start', 'restart', 'unpause'):
+            state.update(Status='running', Running=True, StartedAt=_now())
+            eng.emit(cntr, 'start')
+        elif action in ('stop', 'kill'):
+            if state['Running']:
+                state.update(Status='exited', Running=False, FinishedAt=_now())
+                eng.emit(cntr, 'die')
+                eng.emit(cntr, 'stop')
+            if cntr['HostConfig']['AutoRemove']:
+                eng._drop(cntr)
+                eng.emit(cntr, 'destroy')
+        elif action == 'rename':
+            old = cntr['Name']
+            with eng.lock:
+                taken = qry['name'] in eng.names
+                if not taken:
+                    eng.names.pop(old[1:], None)
+                    eng.names[qry['name']] = cntr['Id']
+                    cntr['Name'] = f"/{qry['name']}"
+            if taken:
+                self._send(409, {'message': f"Conflict. The container name \"/{qry['name']}\" is already in use"})
+                return
+            eng.emit(cntr, 'rename', oldName=old)
+        self._send(204)
+
+    def _remove(self, qry, ref):
+        eng = self.eng
+        cntr = eng._find(ref)
+        if cntr is None:
+            self._send(404, {'message': f"No such container: {ref}"})
+            return
+        eng._drop(cntr)
+        if cntr['State']['Running']:
+            eng.emit(cntr, 'die')
+        eng.emit(cntr, 'destroy')
+        self._send(204)
+
+    def _logs(self, qry, ref):
+        cntr = self.eng._find(ref)
+        if cntr is None:
+            self._send(404, {'message': f"No such container: {ref}"})
+            return
+        follow = qry.get('follow') in ('1', 'true', 'True')
+        self._stream_start('application/vnd.docker.raw-stream')
+        try:
+            indx = 0
+            while True:
+                self._chunk(f"{_now()} {cntr['Name'][1:]} log line {indx}\n".encode())
+                indx += 1
+                if not follow and indx >= 10:
+                    break
+                if follow:
+                    time.sleep(0.2)
+                if cntr['Id'] not in self.eng.cntrs:
+                    break
+            self._chunk(b'')
+        except OSError:
+            self.close_connection = True
+
+    def _stats(self, qry, ref):
+        cntr = self.eng._find(ref)
+        if cntr is None:
+            self._send(404, {'message': f"No such container: {ref}"})
+            return
+
+        def sample():
+            busy = cntr['Config']['Labels'].get('fake.busy', 'true') == 'true'
+            cntr['_cpu'] += random.randint(10**8, 10**9) if busy else 1000
+            cntr['_rx'] += random.randint(10**4, 10**6) if busy else 0
+            cntr['_tx'] += random.randint(10**4, 10**6) if busy else 0
+            return {'read': _now(),
+                    'cpu_stats': {'cpu_usage': {'total_usage': cntr['_cpu']},
+                                  'system_cpu_usage': time.time_ns() * 16, 'online_cpus': 16},
+                    'precpu_stats': {'cpu_usage': {'total_usage': 0}},
+                    'memory_stats': {'usage': random.randint(10**7, 10**8),
+                                     'limit': cntr['HostConfig']['Memory']},
+                    'networks': {'eth0': {'rx_bytes': cntr['_rx'], 'tx_bytes': cntr['_tx']}}}
+
+        if qry.get('stream') in ('0', 'false', 'False'):
+            self._send(200, sample())
+            return
+        self._stream_start()
+        try:
+            while cntr['Id'] in self.eng.cntrs:
+                self._chunk(json.dumps(sample()).encode() + b'\n')
+                time.sleep(1)
+            self._chunk(b'')
+        except OSError:
+            self.close_connection = True
+
+    # ---- images
+    def _images_list(self, qry):
+        eng = self.eng
+        filters = json.loads(qry.get('filters', '{}'))
+        refs = filters.get('reference', [])
+        if isinstance(refs, dict):
+            refs = [k for k, v in refs.items() if v]
+        with eng.lock:
+            lst = [{'Id': i['Id'], 'RepoTags': i['RepoTags'], 'Size': i['Size'],
+                    'Created': int(time.time())}
+                   for i in eng.imgs.values()
+                   if not refs or any(t.startswith(r.rstrip('*')) for t in i['RepoTags'] for r in refs)]
+        self._send(200, lst)
+
+    def _images_inspect(self, qry, ref):
+        img = self.eng.findimage(ref)
+        if img is None:
+            self._send(404, {'message': f"No such image: {ref}"})
+        else:
+            self._send(200, img)
+
+    def _pull(self, qry):
+        eng = self.eng
+        tag = f"{qry.get('fromImage')}:{qry.get('tag') or 'latest'}"
+        # registry stand-in, images named nosuch... don't exist
+        if tag.startswith('nosuch'):
+            self._send(404, {'message': f"manifest for {tag} not found: manifest unknown"})
+            return
+        with eng.lock:
+            imgid = None if eng.findimage(tag) else eng.addimage(tag)
+        if imgid:
+            eng.emitimage(imgid, 'pull', tag)
+        self._stream_start()
+        self._chunk(json.dumps({'status': f"Pulled {tag}"}).encode() + b'\n')
+        self._chunk(b'')
+
+    def _images_remove(self, qry, ref):
+        eng = self.eng
+        img = eng.findimage(ref)
+        if img is None:
+            self._send(404, {'message': f"No such image: {ref}"})
+            return
+        with eng.lock:
+            eng.imgs.pop(img['Id'], None)
+        eng.emitimage(img['Id'], 'delete', ref)
+        self._send(200, [{'Deleted': img['Id']}])
+
+
+_ROUTES = [
+    ('GET', r'/_ping', _Handler._ping),
+    ('HEAD', r'/_ping', _Handler._ping),
+    ('GET', r'/version', _Handler._version),
+    ('GET', r'/info', _Handler._info),
+    ('GET', r'/system/df', _Handler._df),
+    ('GET', r'/events', _Handler._events),
+    ('GET', r'/containers/json', _Handler._containers_list),
+    ('POST', r'/containers/create', _Handler._create),
+    ('GET', r'/containers/([^/]+)/json', _Handler._containers_inspect),
+    ('GET', r'/containers/([^/]+)/logs', _Handler._logs),
+    ('GET', r'/containers/([^/]+)/stats', _Handler._stats),
+    ('POST', r'/containers/([^/]+)/(start|stop|restart|kill|rename|pause|unpause)',
+     _Handler._action),
+    ('DELETE', r'/containers/([^/]+)', _Handler._remove),
+    ('GET', r'/images/json', _Handler._images_list),
+    ('POST', r'/images/create', _Handler._pull),
+    ('GET', r'/images/(.+)/json', _Handler._images_inspect),
+    ('DELETE', r'/images/(.+)', _Handler._images_remove),
+]
+
+
+def _dispatch(method, path):
+    for mthd, pattern, handler in _ROUTES:
+        match = re.fullmatch(pattern, path)
+        if mthd == method and match:
+            return handler, match.groups()
+    raise LookupError(path)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--socket', default='/tmp/fakedocker.sock')
+    parser.add_argument('--containers', type=int, default=10)
+    parser.add_argument('--images', type=int, default=10)
+    args = parser.parse_args()
+    eng = FakeEngine(args.socket, containers=args.containers, images=args.images).start()
+    print(f"Fake docker engine on {eng.url}, DOCKER_HOST={eng.url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        eng.stop()
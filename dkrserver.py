@@ -3,18 +3,81 @@
 """ Exposes Docker run as an API """
 
 import os
+import sys
+import time
+import bisect
+import fnmatch
+import uuid
+import hashlib
+import asyncio
+import functools
 import socket
+import socketserver
+import atexit
+import queue
+import threading
 from pathlib import Path
 import json
 import logging
-from logging.handlers import RotatingFileHandler
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from wsgiref import simple_server
 
 from yaml import safe_load
 
+import requests
+
 import docker
 
 import falcon
+import falcon.asgi
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class LogFormatter(logging.Formatter):
+    ''' Text log lines, or JSON records when structured. Records logged through the request adapter carry
+        the request id, username and ip, the request completion record its duration in ms
+    '''
+    FIELDS = ('reqid', 'username', 'ip', 'duration')
+
+    def __init__(self, structured=False):
+        super().__init__("%(asctime)s %(levelname)s %(funcName)s() %(context)s%(message)s")
+        self.structured = structured
+
+    def formatMessage(self, record):
+        context = ''.join(f"{getattr(record, key)} " for key in self.FIELDS[:3]
+                          if getattr(record, key, None) is not None)
+        if getattr(record, 'duration', None) is not None:
+            return self._fmt % dict(vars(record), context=context) + f" {record.duration}ms"
+        return self._fmt % dict(vars(record), context=context)
+
+    def format(self, record):
+        if not self.structured:
+            return super().format(record)
+        doc = {'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+               'level': record.levelname,
+               'func': record.funcName,
+               'msg': record.getMessage()}
+        doc.update((key, getattr(record, key)) for key in self.FIELDS if getattr(record, key, None) is not None)
+        if record.exc_info:
+            doc['exc'] = self.formatException(record.exc_info)
+        return json.dumps(doc, default=str)
+
+
+class LogQueueHandler(QueueHandler):
+    ''' Puts records on the in-process queue as they are, the message and traceback are formatted
+        by the listener thread, not on the request path
+    '''
+    def prepare(self, record):
+        return record
 
 
 def _getlgr(loglevel=logging.WARNING, logfname='', name='dkrapp'):
@@ -42,8 +105,7 @@ def _getlgr(loglevel=logging.WARNING, logfname='', name='dkrapp'):
         flh = RotatingFileHandler(logfname,
                                   mode="a", maxBytes=5000000, #5MB files
                                   backupCount=3)
-        fmt = logging.Formatter("%(asctime)s %(levelname)s %(funcName)s() %(message)s")
-        flh.setFormatter(fmt)
+        flh.setFormatter(LogFormatter())
         lgr.addHandler(flh)
         lgr.propagate = False
     return lgr
@@ -52,9 +114,26 @@ _LOGGER = _getlgr()
 
 
 class CustomAdapter(logging.LoggerAdapter):
-    ''' Customer Adapter to capture ip and username on log files'''
+    ''' Customer Adapter to capture request id, ip and username on log files.
+        loglevel in extra, when set, applies to this adapter only, the logger level is left as is
+    '''
     def process(self, msg, kwargs):
-        return f"{self.extra['username']} {self.extra['ip']} {msg}", kwargs
+        kwargs['extra'] = {'username': self.extra['username'], 'ip': self.extra['ip'],
+                           'reqid': self.extra.get('reqid'), **kwargs.get('extra', {})}
+        return msg, kwargs
+
+    def isEnabledFor(self, level):
+        loglevel = self.extra.get('loglevel')
+        if loglevel is None:
+            return self.logger.isEnabledFor(level)
+        return level >= loglevel
+
+    def log(self, level, msg, *args, **kwargs):
+        if self.isEnabledFor(level):
+            msg, kwargs = self.process(msg, kwargs)
+            # Bypass the logger level check, report the caller of debug()/info()... as funcName
+            kwargs.setdefault('stacklevel', 2)
+            self.logger._log(level, msg, args, **kwargs) # pylint: disable=protected-access
 
 
 def _load_config(lgr):
@@ -66,6 +145,131 @@ def _load_config(lgr):
 
 _CFG = _load_config(_LOGGER)
 
+
+def _logsetup(lgr, cfg):
+    ''' Apply LOGFORMAT and LOGMODE to the logger file handler. In queue mode requests only put records on
+        a queue, formatting and file writes are done by a background thread. Returns the queue listener
+    '''
+    if any(isinstance(each, QueueHandler) for each in lgr.handlers):
+        return None
+    handlers = lgr.handlers[:]
+    for each in handlers:
+        each.setFormatter(LogFormatter(cfg.get('LOGFORMAT', 'text') == 'json'))
+    if cfg.get('LOGMODE', 'sync') != 'queue':
+        return None
+    que = queue.SimpleQueue()
+    for each in handlers:
+        lgr.removeHandler(each)
+    lgr.addHandler(LogQueueHandler(que))
+    listener = QueueListener(que, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+_LOGLISTENER = _logsetup(_LOGGER, _CFG)
+
+
+class Metrics():
+    ''' Counters, gauges and histograms rendered in the Prometheus text format.
+        Metrics are keyed by a tuple of label values, updates are a dict lookup under a lock
+    '''
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {} # name: [type, help, label names, {label values: value}]
+
+    def define(self, name, mtype, helptext, labelnames=()):
+        ''' Declare a counter, gauge or histogram '''
+        self._metrics[name] = [mtype, helptext, labelnames, {}]
+
+    def inc(self, name, labels=(), value=1):
+        ''' Increment a counter or gauge '''
+        values = self._metrics[name][3]
+        with self._lock:
+            values[labels] = values.get(labels, 0) + value
+
+    def replace(self, name, values):
+        ''' Replace all the values of a gauge, dict of label values: value '''
+        with self._lock:
+            self._metrics[name][3] = values
+
+    def observe(self, name, labels, value):
+        ''' Add an observation to a histogram '''
+        values = self._metrics[name][3]
+        indx = bisect.bisect_left(self.BUCKETS, value)
+        with self._lock:
+            hist = values.get(labels)
+            if hist is None:
+                hist = values[labels] = [[0] * (len(self.BUCKETS) + 1), 0.0]
+            hist[0][indx] += 1
+            hist[1] += value
+
+    @contextmanager
+    def timer(self, name, labels=()):
+        ''' Observe the time spent in the with block '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, labels, time.perf_counter() - start)
+
+    @staticmethod
+    def _escape(val):
+        return f"{val}".replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    @staticmethod
+    def _labels(names, values, extra=''):
+        lbls = [f'{key}="{Metrics._escape(val)}"' for key, val in zip(names, values)]
+        if extra:
+            lbls.append(extra)
+        return '{' + ','.join(lbls) + '}' if lbls else ''
+
+    def render(self):
+        ''' All metrics in the Prometheus text exposition format '''
+        lines = []
+        with self._lock:
+            # copy under the lock, histogram bucket lists are updated in place
+            metrics = [(name, mtype, helptext, lnames,
+                        {key: (list(val[0]), val[1]) if mtype == 'histogram' else val
+                         for key, val in values.items()})
+                       for name, (mtype, helptext, lnames, values) in self._metrics.items()]
+        for name, mtype, helptext, lnames, values in metrics:
+            lines.append(f"# HELP {name} {helptext}")
+            lines.append(f"# TYPE {name} {mtype}")
+            for lvals, val in values.items():
+                if mtype != 'histogram':
+                    lines.append(f"{name}{self._labels(lnames, lvals)} {val}")
+                    continue
+                cumulative = 0
+                for bucket, count in zip(self.BUCKETS + ('+Inf',), val[0]):
+                    cumulative += count
+                    le = f'le="{bucket}"'
+                    lines.append(f"{name}_bucket{self._labels(lnames, lvals, le)} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(lnames, lvals)} {val[1]}")
+                lines.append(f"{name}_count{self._labels(lnames, lvals)} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+_METRICS = Metrics()
+_METRICS.define('dkr_http_requests_total', 'counter', 'HTTP requests', ('route', 'method', 'status'))
+_METRICS.define('dkr_http_request_duration_seconds', 'histogram', 'HTTP request latency', ('route', 'method'))
+_METRICS.define('dkr_http_requests_in_flight', 'gauge', 'HTTP requests being handled', ('route', 'method'))
+_METRICS.define('dkr_docker_call_duration_seconds', 'histogram', 'Docker SDK call latency', ('call',))
+_METRICS.define('dkr_port_select_duration_seconds', 'histogram', 'Time spent selecting a host port')
+_METRICS.define('dkr_user_containers', 'gauge', 'Containers per user', ('user',))
+_METRICS.define('dkr_ports_in_use', 'gauge', 'Host ports MINPRT..MAXPRT in use')
+_METRICS.define('dkr_warm_pool_idle', 'gauge', 'Idle warm pool containers')
+_METRICS.define('dkr_warm_pool_requests_total', 'counter', 'Warm pool hits and misses', ('result',))
+_METRICS.define('dkr_reserved_nano_cpus', 'gauge', 'CPU reserved by running and admitted containers, HOSTCPU in nano cpus')
+_METRICS.define('dkr_reserved_memory_bytes', 'gauge', 'Memory reserved by running and admitted containers, HOSTMEM')
+_METRICS.define('dkr_admission_waiting', 'gauge', 'Launches waiting for host CPU or memory')
+_METRICS.define('dkr_image_pulls_total', 'counter', 'Image pulls', ('result',))
+_METRICS.define('dkr_images_evicted_total', 'counter', 'Images removed to stay within IMAGEBUDGET')
+_METRICS.define('dkr_image_disk_bytes', 'gauge', 'Disk used by images, as of the last eviction check')
+_METRICS.define('dkr_containers_reaped_total', 'counter', 'Idle containers stopped or removed by the reaper', ('action',))
+_METRICS.define('dkr_response_cache_total', 'counter', 'GET results served from the response cache or built',
+                ('result',))
+
 def _allmnts():
     ''' Get list of mounts for running CDP ML container '''
     def getmnt(src, tgt=None, ro=True):
@@ -105,76 +309,1364 @@ def _allmnts():
             mounts.append(getmnt(flpath))
     return mounts
 
-def _customlgr(func):
-    ''' Set the lgr to custom logger, and with loglevel specified in the request.
-        Once loglevel is set on a request, loglevel remains active on all future requests.
-        To reset/change, set to another value in a future request
+OWNERLABEL = 'dkruser.owner'
+
+def _cntrowner(dkrattrs):
+    ''' Owner of the container, from the owner label set at launch. Containers handed out from the warm pool
+        have no label (labels can't be changed after create), they are named <user>.<n> on hand out.
+        Other containers without the label have no owner, see _legacyname
+    '''
+    labels = dkrattrs['Config'].get('Labels') or {}
+    if labels.get(OWNERLABEL):
+        return labels[OWNERLABEL]
+    user, sep, seq = dkrattrs['Name'].lstrip('/').rpartition('.')
+    if sep and user and seq.isdigit():
+        return user
+    return None
+
+def _legacyname(name, username):
+    ''' Container launched before the owner label, named username or username followed by a number,
+        e.g. ryogesh, ryogesh1. Matches the exact user, bob doesn't match bobby
     '''
-    def inner(self, req, resp):
+    return name == username or (name.startswith(username) and name[len(username):].isdigit())
+
+NANOCPUS = 1000000000 # nano cpus per cpu
+DEFAULTCPU = NANOCPUS
+DEFAULTMEM = 512*1024*1024
+MEMUNITS = {'b': 1, 'k': 1024, 'm': 1024*1024, 'g': 1024*1024*1024}
+
+
+def _membytes(value):
+    ''' Memory size in bytes, from bytes or a string with a b, k, m or g suffix e.g. '512m' '''
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    value = f"{value}".strip().lower()
+    if value[-1:] not in MEMUNITS:
+        raise ValueError(f"Invalid memory size {value}")
+    return int(float(value[:-1]) * MEMUNITS[value[-1]])
+
+
+def _launchargs(**kwargs):
+    ''' containers.run arguments common to all launches '''
+    kwargs['log_config'] = docker.types.LogConfig(config={'mode': 'non-blocking',
+                                                          'max-size': '10m',
+                                                          'max-file': '3',
+                                                          'max-buffer-size': '4m'})
+    kwargs['mem_swappiness'] = 0
+    kwargs['init'] = True
+    kwargs['detach'] = True
+    kwargs['tty'] = True
+    return kwargs
+
+def _cntrport(dkrattrs):
+    ''' Host port the container application listens on, from the --port argument or
+        the first published port. 0 when the container doesn't expose a port
+    '''
+    try:
+        indx = dkrattrs['Args'].index('--port')
+        return int(dkrattrs['Args'][indx + 1])
+    except (ValueError, IndexError, KeyError):
+        # Get the values of network settings for exposedport
         try:
-            loglevel = req.context.doc.get('loglevel', None)
-            self.lgr.warning(f"loglevel: {req.context.doc},  {loglevel}")
-            if loglevel:
-                if loglevel in (10, 20, 30, 40, 50):
-                    self.lgr.setLevel(loglevel)
-                elif loglevel.upper() in ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'):
-                    self.lgr.setLevel(loglevel.upper())
-        except AttributeError:
-            self.lgr.debug("No loglevel in body")
-        except ValueError:
-            self.lgr.warning(f"Incorrect loglevel in body: {loglevel}")
-        self.username = req.get_header('username') # default is system user
-        if self.username is None:
-            self.lgr.warning("No Username in header")
-            self.username = "system"
-        self.lgr = CustomAdapter(_LOGGER, {'username': f"{self.username}",
-                                            'ip': f"{req.access_route}"
-                                          }
-                                )
-        return func(self, req, resp)
+            for val in dkrattrs['NetworkSettings']['Ports'].values():
+                return int(val[0]['HostPort'])
+        except (KeyError, TypeError, IndexError, ValueError):
+            pass
+    return 0
+
+def _listquery(req, fields, statuses):
+    ''' GET list query parameters: limit and cursor for pagination, fields selector and status and image filters,
+        lists are comma separated. 400 on an unknown field or status
+    '''
+    query = {'limit': req.get_param_as_int('limit', min_value=1),
+             'cursor': req.get_param('cursor'),
+             'image': req.get_param_as_list('image', delimiter=',')}
+    for param, allowed in (('fields', fields), ('status', statuses)):
+        values = req.get_param_as_list(param, delimiter=',')
+        query[param] = {each.strip().lower() for each in values} if values else None
+        unknown = (query[param] or set()) - set(allowed)
+        if unknown:
+            raise falcon.HTTPInvalidParam(f"unknown {', '.join(sorted(unknown))}, one of {', '.join(allowed)}", param)
+    return query
+
+
+def _page(keys, query):
+    ''' Page of the sorted keys after the cursor, and the cursor of the next page, None on the last page '''
+    if query['cursor'] is not None:
+        keys = keys[bisect.bisect_right(keys, query['cursor']):]
+    if query['limit'] and len(keys) > query['limit']:
+        keys = keys[:query['limit']]
+        return keys, keys[-1]
+    return keys, None
+
+
+def _imagematch(image, patterns):
+    ''' Image reference matches one of the patterns, a pattern without a tag matches all the tags '''
+    return any(fnmatch.fnmatchcase(image, pattern) or fnmatch.fnmatchcase(image, f"{pattern}:*")
+               for pattern in patterns)
+
+
+# Request loglevel, level name or standard level number: level
+LOGLEVELS = {name: getattr(logging, name) for name in ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')}
+LOGLEVELS.update({level: level for level in LOGLEVELS.values()})
+
+
+def _customlgr(func):
+    ''' Set the request username and custom logger on req.context, with loglevel specified in the request.
+        loglevel applies to the request only, the resources hold no per request state
+    '''
+    if asyncio.iscoroutinefunction(func):
+        async def ainner(self, req, resp, **kwargs):
+            _reqcontext(req)
+            return await func(self, req, resp, **kwargs)
+        return ainner
+
+    def inner(self, req, resp, **kwargs):
+        _reqcontext(req)
+        return func(self, req, resp, **kwargs)
     return inner
 
 
+def _reqcontext(req):
+    ''' Request username and logger for _customlgr '''
+    loglevel = None
+    try:
+        loglevel = req.context.doc.get('loglevel', None)
+    except AttributeError:
+        _LOGGER.debug("No loglevel in body")
+    level = None
+    if isinstance(loglevel, (str, int)):
+        level = LOGLEVELS.get(loglevel.upper() if isinstance(loglevel, str) else loglevel)
+    if loglevel is not None and level is None:
+        _LOGGER.warning("Incorrect loglevel in body: %s", loglevel)
+    loglevel = level
+    req.context.username = req.get_header('username') # default is system user
+    if req.context.username is None:
+        _LOGGER.info("No Username in header")
+        req.context.username = "system"
+    req.context.lgr = CustomAdapter(_LOGGER, {'username': f"{req.context.username}",
+                                              'ip': f"{req.access_route}",
+                                              'loglevel': loglevel,
+                                              'reqid': getattr(req.context, 'reqid', None)
+                                             }
+                                   )
+
+
+class DkrAPIClient(docker.APIClient):
+    ''' Docker low level API client. On a socket error the pooled connections are dropped,
+        GET and HEAD requests are retried once on a fresh connection. Other methods may have reached
+        the daemon, they are not retried
+    '''
+    RETRY = ('GET', 'HEAD')
+
+    def request(self, method, url, *args, **kwargs):
+        try:
+            return super().request(method, url, *args, **kwargs)
+        except requests.exceptions.ConnectionError as err:
+            _LOGGER.error("Docker connection error on %s %s: %s, reconnecting", method, url, err)
+            self.close()
+            if method.upper() not in self.RETRY:
+                raise
+            return super().request(method, url, *args, **kwargs)
+
+    def stats_stream(self, container):
+        ''' Decoded stats stream that can be closed from another thread, stats() returns a plain generator '''
+        response = self._get(self._url("/containers/{0}/stats", container), params={'stream': True}, stream=True)
+        self._raise_for_status(response)
+        return docker.types.CancellableStream(self._stream_helper(response, decode=True), response)
+
+
+class DkrClient(docker.DockerClient):
+    ''' Long lived, thread safe docker client shared by all the resources in the process.
+        Connections to the docker daemon are pooled, pool size and timeout are set by
+        DKRPOOLSIZE and DKRTIMEOUT in the config file
+    '''
+    def __init__(self, *args, **kwargs):
+        self.api = DkrAPIClient(*args, **kwargs)
+
+
+class ContainerCache():
+    ''' In-process container state. Loaded once and kept up to date from the docker events stream.
+        The events stream is read in windows of resync seconds; at the end of each window, or when the
+        stream drops, the full container list is reloaded to catch anything that was missed.
+        Containers are indexed by owner, per user lookups don't scan all the containers on the host
+    '''
+    EVENTS = ('create', 'start', 'restart', 'die', 'stop', 'kill', 'oom', 'destroy', 'rename',
+              'pause', 'unpause', 'update')
+    IMAGEEVENTS = ('pull', 'delete', 'tag', 'untag', 'import', 'load')
+
+    def __init__(self, logger, dkr, resync=300):
+        self.lgr = logger
+        self.dkr = dkr
+        self.resync_interval = resync
+        self._lock = threading.Lock()
+        self._cntrs = {} # container id: container object
+        self._owners = {} # username: set of container ids
+        self._names = {} # container name: container id
+        self._ownerof = {} # container id: owner, as indexed
+        self._handouts = {} # container id: owner recorded on warm pool hand out
+        self._legacy = set() # ids of containers without owner, launched before the owner label
+        self._listeners = []
+        self._imglisteners = []
+        self.resync()
+        self._watcher = threading.Thread(target=self._watch, name='dkrcache', daemon=True)
+        self._watcher.start()
+
+    def resync(self):
+        ''' Reload all containers from docker '''
+        with _METRICS.timer('dkr_docker_call_duration_seconds', ('containers.list',)):
+            cntrs = {each.id: each for each in self.dkr.containers.list(all=True, ignore_removed=True)}
+        with self._lock:
+            removed = [each for cid, each in self._cntrs.items() if cid not in cntrs]
+            self._cntrs = {}
+            self._owners = {}
+            self._names = {}
+            self._ownerof = {}
+            self._legacy = set()
+            self._handouts = {cid: owner for cid, owner in self._handouts.items() if cid in cntrs}
+            for each in cntrs.values():
+                self._index(each)
+        self.lgr.info("Container cache loaded with %s containers", len(cntrs))
+        for each in removed:
+            self._notify('discard', each)
+        for each in cntrs.values():
+            self._notify('update', each)
+
+    def subscribe(self, callback):
+        ''' Register callback(action, container), called with action 'update' or 'discard'
+            whenever a container is stored or removed
+        '''
+        self._listeners.append(callback)
+
+    def subscribe_images(self, callback):
+        ''' Register callback(action, image id), called on image events, e.g. pull or delete '''
+        self._imglisteners.append(callback)
+
+    def _notify(self, action, container):
+        for callback in self._listeners:
+            callback(action, container)
+
+    def _index(self, container):
+        ''' Store the container, index by owner and name. Called with the lock held '''
+        self._unindex(container.id)
+        self._cntrs[container.id] = container
+        self._names[container.name] = container.id
+        owner = self._handouts.get(container.id) or _cntrowner(container.attrs)
+        if owner:
+            self._ownerof[container.id] = owner
+            self._owners.setdefault(owner, set()).add(container.id)
+        elif not container.name.startswith(WarmPool.PREFIX):
+            self._legacy.add(container.id)
+
+    def _unindex(self, cid):
+        ''' Remove the container and its index entries. Called with the lock held '''
+        container = self._cntrs.pop(cid, None)
+        if container:
+            self._names.pop(container.name, None)
+            self._legacy.discard(cid)
+            owner = self._ownerof.pop(cid, None)
+            if owner in self._owners:
+                self._owners[owner].discard(cid)
+                if not self._owners[owner]:
+                    del self._owners[owner]
+        return container
+
+    def update(self, container):
+        ''' Store the latest container object '''
+        with self._lock:
+            self._index(container)
+        self._notify('update', container)
+
+    def own(self, container, owner):
+        ''' Store the container handed out to owner '''
+        with self._lock:
+            self._handouts[container.id] = owner
+            self._index(container)
+        self._notify('update', container)
+
+    def owner(self, cid):
+        ''' Owner of the cached container, None if it has none '''
+        with self._lock:
+            return self._ownerof.get(cid)
+
+    def legacy(self, cid):
+        ''' The cached container has no owner and was launched before the owner label '''
+        with self._lock:
+            return cid in self._legacy
+
+    def discard(self, cid):
+        ''' Remove the container from the cache '''
+        with self._lock:
+            self._handouts.pop(cid, None)
+            container = self._unindex(cid)
+        if container:
+            self._notify('discard', container)
+
+    def refresh(self, cid):
+        ''' Reload a single container, drop it from the cache if it no longer exists '''
+        try:
+            with _METRICS.timer('dkr_docker_call_duration_seconds', ('containers.get',)):
+                container = self.dkr.containers.get(cid)
+        except docker.errors.NotFound:
+            self.discard(cid)
+        else:
+            self.update(container)
+
+    def get(self, cid):
+        ''' Cached container object for the container id, None if not cached '''
+        with self._lock:
+            return self._cntrs.get(cid)
+
+    def containers(self):
+        ''' Cached containers, dict of name: [short_id, attrs] '''
+        with self._lock:
+            return {each.name: [each.short_id, each.attrs] for each in self._cntrs.values()}
+
+    def usercontainers(self, username):
+        ''' Cached containers owned by the user and the user's containers from before the owner label,
+            dict of name: [short_id, attrs]
+        '''
+        with self._lock:
+            cntrs = [self._cntrs[cid] for cid in self._owners.get(username, ())]
+            cntrs += [self._cntrs[cid] for cid in self._legacy if _legacyname(self._cntrs[cid].name, username)]
+        return {each.name: [each.short_id, each.attrs] for each in cntrs}
+
+    def owners(self):
+        ''' Number of containers per user '''
+        with self._lock:
+            return {owner: len(cids) for owner, cids in self._owners.items()}
+
+    def exists(self, name):
+        ''' A container with the name exists '''
+        with self._lock:
+            return name in self._names
+
+    def _apply(self, evt):
+        ''' Update the cache for a single container event '''
+        action = evt.get('Action', evt.get('status', '')).split(':')[0]
+        cid = evt.get('Actor', {}).get('ID', evt.get('id'))
+        if evt.get('Type') == 'image':
+            if action in self.IMAGEEVENTS:
+                for callback in self._imglisteners:
+                    callback(action, cid)
+            return
+        if action not in self.EVENTS or not cid:
+            return
+        self.lgr.debug("Container event %s on %s", action, cid)
+        if action == 'destroy':
+            self.discard(cid)
+        else:
+            self.refresh(cid)
+
+    def _watch(self):
+        ''' Follow the docker events stream, resync on every window end or stream failure '''
+        since = int(time.time())
+        while True:
+            until = since + self.resync_interval
+            try:
+                for evt in self.dkr.events(decode=True, since=since, until=until,
+                                           filters={'type': ['container', 'image']}):
+                    self._apply(evt)
+                since = until
+                self.resync()
+            except (docker.errors.DockerException, requests.exceptions.RequestException) as err:
+                self.lgr.error("Container events stream dropped: %s, resyncing", err)
+                time.sleep(1)
+                since = int(time.time())
+                try:
+                    self.resync()
+                except (docker.errors.DockerException, requests.exceptions.RequestException) as err:
+                    self.lgr.error("Container cache resync failed: %s", err)
+
+
+class PortAllocator():
+    ''' Host ports MINPRT..MAXPRT for the default image. Free ports are queued, allocate and release are O(1).
+        Seeded from the ports used by existing containers, kept up to date from the container cache.
+        A port is reserved before the container is launched and released when the container is destroyed
+    '''
+    def __init__(self, logger, cfg, cache):
+        self.lgr = logger
+        self.minprt = cfg['MINPRT']
+        self.maxprt = cfg['MAXPRT']
+        self.probe = cfg['PORTPROBE']
+        self.config = cfg
+        self._lock = threading.Lock()
+        self._free = deque(range(self.minprt, self.maxprt))
+        self._queued = set(self._free)
+        self._used = {} # port: container id, None while the launch is in progress
+        for short_id, dkrattrs in cache.containers().values():
+            self._track('update', dkrattrs)
+        cache.subscribe(lambda action, container: self._track(action, container.attrs))
+
+    def _track(self, action, dkrattrs):
+        ''' Reserve or release the port of a cached container '''
+        port = _cntrport(dkrattrs)
+        if not self.minprt <= port < self.maxprt:
+            return
+        with self._lock:
+            if action == 'update':
+                self._used[port] = dkrattrs['Id']
+            elif self._used.get(port) == dkrattrs['Id']:
+                self._release(port)
+
+    def _release(self, port):
+        self._used.pop(port, None)
+        if port not in self._queued:
+            self._free.append(port)
+            self._queued.add(port)
+
+    def _inuse(self, port):
+        ''' Verify the port is not taken by a process outside of docker '''
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as skt:
+            try:
+                skt.settimeout(0.25)
+                skt.connect((self.config['ip'], port))
+            except OSError:
+                return False
+        return True
+
+    def allocate(self):
+        ''' Reserve a free port, returns None when all ports are in use '''
+        tried = set()
+        while True:
+            with self._lock:
+                port = None
+                while self._free:
+                    candidate = self._free.popleft()
+                    self._queued.discard(candidate)
+                    if candidate not in self._used:
+                        port = candidate
+                        self._used[port] = None
+                        break
+            if port is None or not self.probe or not self._inuse(port):
+                return port
+            # Taken outside of docker, put it back at the end of the queue
+            self.lgr.warning("Port %s is in use outside of docker", port)
+            with self._lock:
+                self._release(port)
+            if port in tried:
+                return None
+            tried.add(port)
+
+    def release(self, port):
+        ''' Release a port reserved for a launch that did not go through '''
+        with self._lock:
+            if self._used.get(port) is None:
+                self._release(port)
+
+    def inuse(self):
+        ''' Number of ports in use '''
+        with self._lock:
+            return len(self._used)
+
+    def free(self):
+        ''' Number of ports free '''
+        with self._lock:
+            return self.maxprt - self.minprt - len(self._used)
+
+
+class Admission():
+    ''' Host CPU and memory reserved by running containers, against HOSTCPU and HOSTMEM (docker info when 0).
+        A launch that fits is admitted right away, otherwise it waits up to ADMITWAIT seconds for running
+        containers to stop. Waiting launches are admitted one user at a time in turn, a user with many waiting
+        launches doesn't hold up the others. Kept up to date from the container cache
+    '''
+    def __init__(self, logger, cfg, dkr, cache):
+        self.lgr = logger
+        self.wait = cfg['ADMITWAIT']
+        info = {} if cfg['HOSTCPU'] and cfg['HOSTMEM'] else dkr.info()
+        self.cpus = int(float(cfg['HOSTCPU'] or info['NCPU']) * NANOCPUS)
+        self.mem = _membytes(cfg['HOSTMEM'] or info['MemTotal'])
+        self._cond = threading.Condition()
+        self._running = {} # container id: (nano cpus, memory bytes)
+        self._admitted = {} # ticket: (nano cpus, memory bytes), launches admitted but not yet running
+        self._waiting = {} # username: deque of waiting tickets
+        self._turns = deque() # users with waiting launches, in turn
+        self._tickets = {} # ticket: (username, nano cpus, memory bytes) for the waiting tickets
+        self.reserved = [0, 0] # nano cpus, memory bytes
+        for short_id, dkrattrs in cache.containers().values():
+            self._track('update', dkrattrs)
+        cache.subscribe(lambda action, container: self._track(action, container.attrs))
+
+    def _reserve(self, key, store, cpus, mem):
+        store[key] = (cpus, mem)
+        self.reserved[0] += cpus
+        self.reserved[1] += mem
+
+    def _unreserve(self, key, store):
+        cpus, mem = store.pop(key, (0, 0))
+        self.reserved[0] -= cpus
+        self.reserved[1] -= mem
+
+    def _fits(self, cpus, mem):
+        return self.reserved[0] + cpus <= self.cpus and self.reserved[1] + mem <= self.mem
+
+    def _track(self, action, dkrattrs):
+        ''' Reserve the CPU and memory limits of a running container, release them once it stops '''
+        with self._cond:
+            self._unreserve(dkrattrs['Id'], self._running)
+            if action == 'update' and dkrattrs['State']['Running']:
+                self._reserve(dkrattrs['Id'], self._running, dkrattrs['HostConfig'].get('NanoCpus') or 0,
+                              dkrattrs['HostConfig'].get('Memory') or 0)
+            else:
+                self._dispatch()
+
+    def _dispatch(self):
+        ''' Admit waiting launches in user turn while they fit. Called with the lock held '''
+        admitted = False
+        while self._turns:
+            username = self._turns[0]
+            ticket = self._waiting[username][0]
+            _, cpus, mem = self._tickets[ticket]
+            if not self._fits(cpus, mem):
+                break
+            self._dequeue(ticket, rotate=True)
+            self._reserve(ticket, self._admitted, cpus, mem)
+            admitted = True
+        if admitted:
+            self._cond.notify_all()
+
+    def _dequeue(self, ticket, rotate=False):
+        ''' Drop a waiting ticket, with rotate the user at the head of the turns goes to the end.
+            Called with the lock held
+        '''
+        username = self._tickets.pop(ticket)[0]
+        self._waiting[username].remove(ticket)
+        if not self._waiting[username]:
+            del self._waiting[username]
+            self._turns.remove(username)
+        elif rotate:
+            self._turns.rotate(-1)
+
+    def admit(self, username, cpus, mem, wait=None):
+        ''' Reserve CPU and memory for a launch. Returns the ticket to release once the container is running
+            or the launch failed, None if it is not admitted in wait (default ADMITWAIT) seconds
+        '''
+        ticket = uuid.uuid4().hex
+        wait = self.wait if wait is None else wait
+        with self._cond:
+            if not self._turns and self._fits(cpus, mem):
+                self._reserve(ticket, self._admitted, cpus, mem)
+                return ticket
+            if not wait or cpus > self.cpus or mem > self.mem:
+                return None
+            self._tickets[ticket] = (username, cpus, mem)
+            self._waiting.setdefault(username, deque()).append(ticket)
+            if username not in self._turns:
+                self._turns.append(username)
+            self.lgr.info("Launch of %s waiting for host CPU or memory", username)
+            if not self._cond.wait_for(lambda: ticket in self._admitted, wait):
+                self._dequeue(ticket)
+                self._dispatch()
+                return None
+        return ticket
+
+    def release(self, ticket):
+        ''' Release the reservation of an admitted launch, the running container is tracked from the cache '''
+        with self._cond:
+            self._unreserve(ticket, self._admitted)
+            self._dispatch()
+
+    def info(self):
+        ''' Reserved and host nano cpus and memory bytes, number of waiting launches '''
+        with self._cond:
+            return {'cpus': self.reserved[0], 'hostcpus': self.cpus,
+                    'memory': self.reserved[1], 'hostmemory': self.mem,
+                    'running': len(self._running), 'waiting': len(self._tickets)}
+
+
+class WarmPool():
+    ''' Idle, started containers of the default image with the standard mounts and limits.
+        A launch of the default image with default settings is handed one of these, renamed for the user,
+        and the pool is refilled in the background. Idle containers older than the max age are replaced
+    '''
+    LABEL = 'dkruser.pool'
+    PREFIX = 'dkrpool-'
+
+    def __init__(self, logger, cfg, dkr, cache, ports, mounts):
+        self.lgr = logger
+        self.config = cfg
+        self.dkr = dkr
+        self.cache = cache
+        self.ports = ports
+        self.mounts = mounts
+        self.size = cfg['WARMPOOL']
+        self.maxage = cfg['WARMMAXAGE']
+        self.stats = {'hits': 0, 'misses': 0}
+        self._lock = threading.Lock()
+        self._idle = deque() # (container, created epoch)
+        self._pending = 0
+        self._executor = ThreadPoolExecutor(max_workers=cfg['WARMREFILL'], thread_name_prefix='dkrpool')
+        cache.subscribe(self._track)
+        if self.size:
+            self._adopt()
+            threading.Thread(target=self._maintain, name='dkrpool', daemon=True).start()
+
+    def _adopt(self):
+        ''' Reuse idle pool containers left from a previous run '''
+        for short_id, dkrattrs in self.cache.containers().values():
+            if dkrattrs['Name'].lstrip('/').startswith(self.PREFIX) and dkrattrs['State']['Running']:
+                created = datetime.strptime(dkrattrs['Created'][:19], '%Y-%m-%dT%H:%M:%S')
+                created = created.replace(tzinfo=timezone.utc).timestamp()
+                self._idle.append((self.cache.get(dkrattrs['Id']), created))
+        self.lgr.info("Warm pool adopted %s idle containers", len(self._idle))
+
+    def _track(self, action, container):
+        ''' Drop idle containers that are stopped or removed outside of the pool '''
+        if action == 'discard' or not container.attrs['State']['Running']:
+            with self._lock:
+                idle = [each for each in self._idle if each[0].id != container.id]
+                if len(idle) == len(self._idle):
+                    return
+                self._idle = deque(idle)
+            self.refill()
+
+    def match(self, image, cmdlst, post_dct):
+        ''' Launch request can be served from the pool '''
+        return bool(self.size) and image == self.config['DEFAULTIMG'] and not cmdlst \
+               and post_dct.get('nano_cpus') == DEFAULTCPU and post_dct.get('mem_limit') == DEFAULTMEM \
+               and post_dct['remove'] == self.config['WARMREMOVE']
+
+    def take(self, username, exists=None):
+        ''' Hand out an idle container to the user, None when the pool is empty. The container is renamed to
+            <username>.<n>, the first name exists() doesn't report, the name records the owner across restarts
+        '''
+        exists = exists or self.cache.exists
+        container = None
+        while container is None:
+            with self._lock:
+                if not self._idle:
+                    self.stats['misses'] += 1
+                    break
+                container = self._idle.popleft()[0]
+            seq = 0
+            while exists(f"{username}.{seq}"):
+                seq += 1
+            name = f"{username}.{seq}"
+            try:
+                container.rename(name)
+                container.reload()
+            except docker.errors.NotFound:
+                container = None
+            except docker.errors.APIError as err:
+                self.lgr.error("Failed to hand out %s as %s: %s", container.name, name, err)
+                with self._lock:
+                    self._idle.appendleft((container, time.time()))
+                    self.stats['misses'] += 1
+                container = None
+                break
+            else:
+                self.cache.own(container, username)
+                with self._lock:
+                    self.stats['hits'] += 1
+        self.refill()
+        return container
+
+    def refill(self):
+        ''' Start containers in the background until the pool is full '''
+        with self._lock:
+            needed = self.size - len(self._idle) - self._pending
+            self._pending += max(needed, 0)
+        for _ in range(needed):
+            self._executor.submit(self._create)
+
+    def _create(self):
+        port = self.ports.allocate()
+        try:
+            if port is None:
+                self.lgr.error("Warm pool refill failed, no free port")
+                return
+            post_dct = _launchargs(name=f"{self.PREFIX}{uuid.uuid4().hex[:12]}",
+                                   labels={self.LABEL: 'warm'}, network_mode='host', mounts=self.mounts,
+                                   nano_cpus=DEFAULTCPU, mem_limit=DEFAULTMEM,
+                                   remove=self.config['WARMREMOVE'])
+            with _METRICS.timer('dkr_docker_call_duration_seconds', ('containers.run',)):
+                container = self.dkr.containers.run(self.config['DEFAULTIMG'],
+                                                    ["start-process.sh", "--port", str(port)], **post_dct)
+            container.reload()
+        except docker.errors.DockerException as err:
+            self.lgr.error("Warm pool refill failed: %s", err)
+            if port:
+                self.ports.release(port)
+        else:
+            self.cache.update(container)
+            with self._lock:
+                self._idle.append((container, time.time()))
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def _maintain(self):
+        ''' Replace idle containers older than the max age, no max age when 0, keep the pool full '''
+        while True:
+            expired = []
+            with self._lock:
+                now = time.time()
+                for each in list(self._idle):
+                    if self.maxage and now - each[1] > self.maxage:
+                        self._idle.remove(each)
+                        expired.append(each[0])
+            for container in expired:
+                try:
+                    container.remove(force=True)
+                except docker.errors.DockerException as err:
+                    self.lgr.error("Failed to remove expired pool container %s: %s", container.name, err)
+            self.refill()
+            # at least a second between rounds, a tiny max age would spin
+            time.sleep(max(1, min(60, self.maxage / 2)) if self.maxage else 60)
+
+    def info(self):
+        ''' Pool size and hit/miss counts '''
+        with self._lock:
+            return {'size': self.size, 'idle': len(self._idle), 'starting': self._pending, **self.stats}
+
+
+class ImageManager():
+    ''' Images of a docker host. DEFAULTIMG and PREPULL are pulled in the background at startup and every
+        PREPULLINTERVAL seconds, PULLWORKERS pulls at a time, a launch of a missing image waits on the same pull.
+        When the images on disk exceed IMAGEBUDGET, the least recently launched images that no container uses
+        are removed, pre-pulled images are never removed. Last launch times are kept in memory, an image not
+        launched since startup counts from its creation
+    '''
+    def __init__(self, logger, cfg, dkr, cache):
+        self.lgr = logger
+        self.dkr = dkr
+        self.cache = cache
+        self.pinned = list(dict.fromkeys(self.ref(each) for each in [cfg['DEFAULTIMG']] + (cfg['PREPULL'] or [])))
+        self.interval = cfg['PREPULLINTERVAL']
+        self.budget = _membytes(cfg['IMAGEBUDGET']) if cfg['IMAGEBUDGET'] else 0
+        self.disk = 0
+        self._lock = threading.Lock()
+        self._evicting = threading.Lock()
+        self._pulls = {} # image reference: pull future
+        self._lastuse = {} # image id: epoch of the last launch
+        self._tags = {} # image reference: image id
+        self._stale = True
+        self._listeners = []
+        self._executor = ThreadPoolExecutor(max_workers=cfg['PULLWORKERS'], thread_name_prefix='dkrpull')
+        cache.subscribe_images(lambda action, imgid: self._invalidate())
+        threading.Thread(target=self._maintain, name='dkrimages', daemon=True).start()
+
+    @staticmethod
+    def ref(image):
+        ''' Image reference with the tag, latest when it has none '''
+        repo, tag = docker.utils.parse_repository_tag(image)
+        return image if tag else f"{repo}:latest"
+
+    def subscribe(self, callback):
+        ''' Register callback(image reference), called when a pull starts or ends '''
+        self._listeners.append(callback)
+
+    def _notify(self, ref):
+        for callback in self._listeners:
+            callback(ref)
+
+    def _invalidate(self):
+        with self._lock:
+            self._stale = True
+
+    def _refresh(self):
+        ''' Reload the tags on the host, after an image event or pull '''
+        with self._lock:
+            if not self._stale:
+                return
+            self._stale = False
+        with _METRICS.timer('dkr_docker_call_duration_seconds', ('images.list',)):
+            images = self.dkr.api.images()
+        tags = {tag: each['Id'] for each in images for tag in each.get('RepoTags') or ()}
+        with self._lock:
+            self._tags = tags
+
+    def present(self, image):
+        ''' The image is on the host. Image ids and digests are left to docker, treated as present '''
+        if image.startswith('sha256:') or '@' in image:
+            return True
+        self._refresh()
+        with self._lock:
+            return self.ref(image) in self._tags
+
+    def pull(self, image):
+        ''' Pull the image in the background, returns the pull future. A pull of the image already running is shared '''
+        ref = self.ref(image)
+        with self._lock:
+            fut = self._pulls.get(ref)
+            started = fut is None
+            if started:
+                fut = self._pulls[ref] = self._executor.submit(self._pull, ref)
+        if started:
+            self._notify(ref)
+        return fut
+
+    def _pull(self, ref, quiet=False):
+        ''' Pull the image. quiet, a refresh of a present image: not shown as pulling, a failure is only logged,
+            a locally built image has no registry to pull from
+        '''
+        repo, tag = docker.utils.parse_repository_tag(ref)
+        self.lgr.info("%s image %s", "Refreshing" if quiet else "Pulling", ref)
+        try:
+            with _METRICS.timer('dkr_docker_call_duration_seconds', ('images.pull',)):
+                # pull errors, e.g. on a layer, are reported in the progress stream
+                for line in self.dkr.api.pull(repo, tag=tag, stream=True, decode=True):
+                    if 'error' in line:
+                        raise docker.errors.APIError(line['error'])
+        except (docker.errors.DockerException, requests.exceptions.RequestException) as err:
+            if quiet:
+                self.lgr.debug("Refresh of image %s failed, present image kept: %s", ref, err)
+                return
+            self.lgr.error("Pull of image %s failed: %s", ref, err)
+            _METRICS.inc('dkr_image_pulls_total', ('failed',))
+            raise
+        finally:
+            with self._lock:
+                if not quiet:
+                    self._pulls.pop(ref, None)
+                self._stale = True
+            self._notify(ref)
+        self.lgr.info("Pulled image %s", ref)
+        _METRICS.inc('dkr_image_pulls_total', ('succeeded',))
+        self.evict()
+
+    def pulling(self):
+        ''' Image references being pulled '''
+        with self._lock:
+            return list(self._pulls)
+
+    def touch(self, imgid):
+        ''' Record a launch of the image '''
+        with self._lock:
+            self._lastuse[imgid] = time.time()
+
+    def lastuse(self, imgid):
+        ''' Epoch of the last launch of the image since startup, None if not launched '''
+        with self._lock:
+            return self._lastuse.get(imgid)
+
+    def states(self):
+        ''' Images that can't be evicted, image id: pinned (pre-pulled) or in use (by a container) '''
+        self._refresh()
+        states = {dkrattrs['Image']: 'in use' for short_id, dkrattrs in self.cache.containers().values()}
+        with self._lock:
+            states.update({self._tags[ref]: 'pinned' for ref in self.pinned if ref in self._tags})
+        return states
+
+    def evict(self):
+        ''' Remove the least recently launched images no container uses, until the images fit IMAGEBUDGET '''
+        if not self.budget or not self._evicting.acquire(blocking=False):
+            return
+        try:
+            with _METRICS.timer('dkr_docker_call_duration_seconds', ('df',)):
+                usage = self.dkr.api.df()
+            self.disk = usage.get('LayersSize') or 0
+            if self.disk <= self.budget:
+                return
+            keep = self.states()
+            pulling = self.pulling()
+            candidates = [img for img in usage.get('Images') or ()
+                          if img['Id'] not in keep and img.get('Containers', 0) <= 0
+                          and not set(img.get('RepoTags') or ()) & set(pulling)]
+            candidates.sort(key=lambda img: self.lastuse(img['Id']) or img.get('Created', 0))
+            for img in candidates:
+                if self.disk <= self.budget:
+                    break
+                # untag, removing the last tag removes the image. Removing by id fails on an image with several tags
+                tags = [tag for tag in img.get('RepoTags') or () if tag != '<none>:<none>'] or [img['Id']]
+                try:
+                    for tag in tags:
+                        with _METRICS.timer('dkr_docker_call_duration_seconds', ('images.remove',)):
+                            self.dkr.api.remove_image(tag)
+                except docker.errors.APIError as err:
+                    self.lgr.warning("Image %s not evicted: %s", tags[0], err)
+                    continue
+                self.disk -= max(img['Size'] - max(img.get('SharedSize', 0), 0), 0)
+                with self._lock:
+                    self._lastuse.pop(img['Id'], None)
+                _METRICS.inc('dkr_images_evicted_total')
+                self.lgr.warning("Evicted image %s, images on disk %.0fMB, budget %.0fMB", tags[0],
+                                 self.disk/(1024*1024), self.budget/(1024*1024))
+        except (docker.errors.DockerException, requests.exceptions.RequestException) as err:
+            self.lgr.error("Image eviction failed: %s", err)
+        finally:
+            self._evicting.release()
+
+    def _maintain(self):
+        ''' Pre-pull at startup and every PREPULLINTERVAL seconds, only at startup when 0 '''
+        while True:
+            # present images are refreshed quietly, missing ones pulled as for a launch
+            futs = [self._executor.submit(self._pull, ref, quiet=True) if self.present(ref) else self.pull(ref)
+                    for ref in self.pinned]
+            for fut in futs:
+                try:
+                    fut.result()
+                except (docker.errors.DockerException, requests.exceptions.RequestException):
+                    pass # logged by the pull
+            self.evict()
+            if not self.interval:
+                return
+            time.sleep(self.interval)
+
+
+class DkrHost():
+    ''' A docker engine containers are launched on, an entry of DKRHOSTS: url of the engine, host name used in
+        the application url of its containers and optionally HOSTCPU/HOSTMEM. Holds the engine's client,
+        container cache, port allocator, admission, warm pool and image manager
+    '''
+    def __init__(self, logger, cfg, entry, mounts):
+        self.url = entry.get('url')
+        if self.url:
+            self.dkr = DkrClient(base_url=self.url, max_pool_size=cfg['DKRPOOLSIZE'], timeout=cfg['DKRTIMEOUT'])
+        else:
+            # local engine, DOCKER_HOST or the default socket
+            self.dkr = DkrClient.from_env(max_pool_size=cfg['DKRPOOLSIZE'], timeout=cfg['DKRTIMEOUT'])
+        remote = urlparse(self.url or '').hostname
+        self.host = entry.get('host') or remote or socket.getfqdn()
+        # the port probe and the capacity are the engine's own
+        hostcfg = dict(cfg, ip=socket.gethostbyname(self.host),
+                       HOSTCPU=entry.get('HOSTCPU', cfg['HOSTCPU']), HOSTMEM=entry.get('HOSTMEM', cfg['HOSTMEM']))
+        self.cache = ContainerCache(logger, self.dkr, cfg['CACHERESYNC'])
+        self.ports = PortAllocator(logger, hostcfg, self.cache)
+        self.admission = Admission(logger, hostcfg, self.dkr, self.cache)
+        self.pool = WarmPool(logger, hostcfg, self.dkr, self.cache, self.ports, mounts)
+        self.images = ImageManager(logger, hostcfg, self.dkr, self.cache)
+
+    def load(self):
+        ''' Placement order, least loaded first: share of CPU or memory reserved, running containers, free ports '''
+        adm = self.admission.info()
+        share = max(adm['cpus']/adm['hostcpus'], adm['memory']/adm['hostmemory'])
+        return round(share, 2), adm['running'], -self.ports.free()
+
+
+class LaunchJobs():
+    ''' Asynchronous launches. Jobs run on a bounded worker pool, the number of jobs waiting for a worker
+        is limited, a full queue rejects new jobs. Finished jobs are kept for JOBTTL seconds
+    '''
+    def __init__(self, logger, cfg):
+        self.lgr = logger
+        self.maxqueue = cfg['JOBQUEUE']
+        self.ttl = cfg['JOBTTL']
+        self._lock = threading.Lock()
+        self._jobs = {} # job id: job details
+        self._executor = ThreadPoolExecutor(max_workers=cfg['JOBWORKERS'], thread_name_prefix='dkrjob')
+
+    def _prune(self):
+        now = time.time()
+        for jid in [jid for jid, job in self._jobs.items()
+                    if job['status'] in ('succeeded', 'failed') and now - job['_finished'] > self.ttl]:
+            del self._jobs[jid]
+
+    def submit(self, username, name, func):
+        ''' Queue func(progress), which returns http status and result and can report progress(status, condition).
+            Returns the job, None when the queue is full
+        '''
+        with self._lock:
+            self._prune()
+            if sum(1 for job in self._jobs.values() if job['status'] == 'queued') >= self.maxqueue:
+                return None
+            jid = uuid.uuid4().hex
+            self._jobs[jid] = {'job id': jid, 'username': username, 'container name': name,
+                               'status': 'queued',
+                               'submitted': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')}
+            job = self._public(self._jobs[jid])
+        self._executor.submit(self._run, jid, func)
+        return job
+
+    def _run(self, jid, func):
+        with self._lock:
+            job = self._jobs[jid]
+            job['status'] = 'running'
+        try:
+            status, result = func(functools.partial(self._progress, jid))
+        except Exception as err: # pylint: disable=broad-except
+            # Any failure must finish the job, else it shows running forever
+            self.lgr.error("Launch job %s failed: %s", jid, err, exc_info=True)
+            status, result = falcon.HTTP_500, {"condition": f"{err}"}
+        with self._lock:
+            job.pop('condition', None)
+            if status == falcon.HTTP_201:
+                job['status'] = 'succeeded'
+                job['container'] = result
+            else:
+                job['status'] = 'failed'
+                job['error'] = result
+            job['_finished'] = time.time()
+
+    def _progress(self, jid, status, condition=None):
+        ''' Status of a running job, e.g. pulling with the image in condition '''
+        with self._lock:
+            job = self._jobs[jid]
+            job['status'] = status
+            if condition:
+                job['condition'] = condition
+            else:
+                job.pop('condition', None)
+
+    @staticmethod
+    def _public(job):
+        return {key: val for key, val in job.items() if not key.startswith('_')}
+
+    def get(self, jid):
+        ''' Job details, None if the job doesn't exist or has expired '''
+        with self._lock:
+            self._prune()
+            job = self._jobs.get(jid)
+            return self._public(job) if job else None
+
+    def pending(self, username):
+        ''' Container names of the queued and running launches of the user '''
+        with self._lock:
+            return [job['container name'] for job in self._jobs.values()
+                    if job['username'] == username and job['status'] in ('queued', 'running')]
+
+
+class IdleReaper():
+    ''' Stops containers that stay idle. Every REAPINTERVAL seconds the running user containers are sampled with
+        one shot stats, REAPWORKERS at a time. A container that used less than REAPCPU CPUs and less than REAPNET
+        bytes/s of network since the previous sample is idle. Idle for REAPIDLE seconds, it is stopped, which
+        removes a container launched with remove. Host network containers have no network stats, only the CPU counts
+    '''
+    HISTORY = 100 # reaped containers kept for the /reaper endpoint
+
+    def __init__(self, logger, cfg, launcher):
+        self.lgr = logger
+        self.launcher = launcher
+        self.idle = cfg['REAPIDLE']
+        self.interval = cfg['REAPINTERVAL']
+        self.maxcpu = cfg['REAPCPU']
+        self.maxnet = cfg['REAPNET']
+        self._lock = threading.Lock()
+        self._samples = {} # container id: (epoch, cpu usage ns, network bytes)
+        self._idlesince = {} # container id: epoch idle since
+        self._reaped = deque(maxlen=self.HISTORY)
+        self._executor = ThreadPoolExecutor(max_workers=cfg['REAPWORKERS'], thread_name_prefix='dkrreap')
+        if self.idle:
+            threading.Thread(target=self._maintain, name='dkrreaper', daemon=True).start()
+
+    def _candidates(self):
+        ''' Running user containers, warm pool containers are idle by design '''
+        return [(name, dkrattrs, host) for name, (short_id, dkrattrs, host) in self.launcher.containers().items()
+                if dkrattrs['State']['Running'] and
+                (host.cache.owner(dkrattrs['Id']) or host.cache.legacy(dkrattrs['Id']))]
+
+    @staticmethod
+    def _sample(host, cid):
+        ''' Total CPU usage in nano seconds and network bytes received and sent '''
+        with _METRICS.timer('dkr_docker_call_duration_seconds', ('containers.stats',)):
+            stats = host.dkr.api.stats(cid, stream=False, one_shot=True)
+        cpu = stats.get('cpu_stats', {}).get('cpu_usage', {}).get('total_usage', 0)
+        net = sum(nic.get('rx_bytes', 0) + nic.get('tx_bytes', 0) for nic in (stats.get('networks') or {}).values())
+        return time.time(), cpu, net
+
+    def _check(self, name, dkrattrs, host):
+        ''' Sample the container, reap it when idle for long enough '''
+        cid = dkrattrs['Id']
+        try:
+            now, cpu, net = self._sample(host, cid)
+        except docker.errors.NotFound:
+            return
+        except (docker.errors.DockerException, requests.exceptions.RequestException) as err:
+            self.lgr.warning("Stats of %s failed: %s", name, err)
+            return
+        with self._lock:
+            prev = self._samples.get(cid)
+            self._samples[cid] = (now, cpu, net)
+            if prev is None or now <= prev[0]:
+                return
+            elapsed = now - prev[0]
+            cpus = (cpu - prev[1]) / NANOCPUS / elapsed
+            netrate = (net - prev[2]) / elapsed
+            if cpus >= self.maxcpu or netrate >= self.maxnet:
+                self._idlesince.pop(cid, None)
+                return
+            # idle over the whole interval since the previous sample
+            since = self._idlesince.setdefault(cid, prev[0])
+            if now - since < self.idle:
+                return
+        self._reap(name, dkrattrs, host, cpus, netrate, now - since)
+
+    def _reap(self, name, dkrattrs, host, cpus, netrate, idle):
+        container = host.dkr.containers.prepare_model(dkrattrs)
+        owner = host.cache.owner(container.id)
+        try:
+            status, result = self.launcher.action(container, 'stop', self.lgr)
+        except (docker.errors.DockerException, requests.exceptions.RequestException) as err:
+            status, result = None, f"{err}"
+        with self._lock:
+            self._samples.pop(container.id, None)
+            self._idlesince.pop(container.id, None)
+        if status != falcon.HTTP_200:
+            self.lgr.error("Failed to stop idle container %s: %s", name, result)
+            return
+        action = 'removed' if dkrattrs['HostConfig'].get('AutoRemove') else 'stopped'
+        entry = {'container name': name,
+                 'container id': container.short_id,
+                 'owner': owner,
+                 'host': host.host,
+                 'action': action,
+                 'idle': f"{idle:.0f}s",
+                 'cpus': round(cpus, 4),
+                 'network': f"{netrate:,.0f}B/s",
+                 'time': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')}
+        with self._lock:
+            self._reaped.append(entry)
+        _METRICS.inc('dkr_containers_reaped_total', (action,))
+        self.lgr.warning("Idle container %s of %s %s, idle %.0fs, %.4f CPUs, %.0f network B/s", name,
+                         entry['owner'], action, idle, cpus, netrate)
+
+    def _maintain(self):
+        ''' Sample all the candidates every REAPINTERVAL seconds '''
+        while True:
+            start = time.monotonic()
+            cntrs = self._candidates()
+            live = {dkrattrs['Id'] for name, dkrattrs, host in cntrs}
+            with self._lock:
+                self._samples = {cid: val for cid, val in self._samples.items() if cid in live}
+                self._idlesince = {cid: val for cid, val in self._idlesince.items() if cid in live}
+            for fut in [self._executor.submit(self._check, *each) for each in cntrs]:
+                fut.result()
+            # at least a second between rounds, REAPINTERVAL 0 would spin
+            time.sleep(max(self.interval - (time.monotonic() - start), 1))
+
+    def info(self, username=None):
+        ''' Idle containers and the containers reaped, only the user's when username is given '''
+        now = time.time()
+        with self._lock:
+            idlesince = dict(self._idlesince)
+            reaped = [each for each in self._reaped if username is None or each['owner'] == username or
+                      (each['owner'] is None and _legacyname(each['container name'], username))]
+        idle = [{'container name': name,
+                 'idle': f"{now - idlesince[dkrattrs['Id']]:.0f}s",
+                 'reaped in': f"{max(self.idle - (now - idlesince[dkrattrs['Id']]), 0):.0f}s"}
+                for name, (short_id, dkrattrs, host) in self.launcher.containers(username).items()
+                if dkrattrs['Id'] in idlesince]
+        return {'idle after': f"{self.idle}s" if self.idle else 'disabled',
+                'idle containers': idle,
+                'reaped': reaped}
+
+
+class ContainerStream():
+    ''' Logs or stats of a container as (event, text) pairs. Docker output is read by pump() in a stream
+        thread into a bounded queue, a full queue stops the reads until the client catches up.
+        close() ends the docker stream and the pump, done is called once on close
+    '''
+    def __init__(self, container, kind, cfg, done=None):
+        self.container = container
+        self.kind = kind
+        self.tail = cfg['STREAMTAIL']
+        self.heartbeat = cfg['STREAMHEARTBEAT']
+        self.events = queue.Queue(maxsize=cfg['STREAMBUFFER'])
+        self.closed = threading.Event()
+        self.notify = None # wakes an ASGI consumer after each put
+        self.done = done
+        self._dkrstream = None
+
+    def _put(self, item):
+        ''' Wait for room in the queue, False once the stream is closed '''
+        while not self.closed.is_set():
+            try:
+                self.events.put(item, timeout=1)
+            except queue.Full:
+                continue
+            if self.notify:
+                self.notify()
+            return True
+        return False
+
+    def pump(self):
+        ''' Copy the docker stream to the queue, ends with None '''
+        try:
+            if self.kind == 'logs':
+                self._dkrstream = self.container.logs(stream=True, follow=True, tail=self.tail)
+            else:
+                self._dkrstream = self.container.client.api.stats_stream(self.container.id)
+            if self.closed.is_set():
+                self._dkrstream.close()
+            if self.kind == 'logs':
+                self._lines()
+            else:
+                for stats in self._dkrstream:
+                    if not self._put(('stats', json.dumps(stats))):
+                        break
+        except (docker.errors.APIError, requests.exceptions.RequestException) as err:
+            self._put(('error', f"{err}"))
+        finally:
+            self._put(None)
+
+    def _lines(self):
+        ''' Log output, tty containers stream a byte at a time, one event per line '''
+        buf = bytearray()
+        for chunk in self._dkrstream:
+            buf += chunk
+            if b'\n' not in chunk:
+                continue
+            *lines, rest = buf.split(b'\n')
+            buf = bytearray(rest)
+            for line in lines:
+                if not self._put(('log', line.decode(errors='replace').rstrip('\r'))):
+                    return
+        if buf:
+            self._put(('log', buf.decode(errors='replace')))
+
+    def close(self):
+        ''' End the stream '''
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        if self._dkrstream is not None:
+            self._dkrstream.close()
+        if self.done:
+            self.done()
+
+    def __iter__(self):
+        ''' Server-Sent Events, WSGI. The server calls close() when the client is gone '''
+        while True:
+            try:
+                item = self.events.get(timeout=self.heartbeat)
+            except queue.Empty:
+                yield b': ping\n\n'
+                continue
+            if item is None:
+                return
+            yield f"event: {item[0]}\ndata: {item[1]}\n\n".encode()
+
+    async def sse(self):
+        ''' Server-Sent Events, ASGI. None for a keepalive when idle for heartbeat seconds '''
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        self.notify = lambda: loop.call_soon_threadsafe(ready.set)
+        try:
+            while True:
+                ready.clear()
+                try:
+                    item = self.events.get_nowait()
+                except queue.Empty:
+                    try:
+                        await asyncio.wait_for(ready.wait(), self.heartbeat)
+                    except asyncio.TimeoutError:
+                        yield None
+                    continue
+                if item is None:
+                    return
+                yield falcon.asgi.SSEvent(event=item[0], text=item[1])
+        finally:
+            self.close()
+
+
+class MetricsMiddleware():
+    ''' Request count, latency and in-flight requests per route and method '''
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def process_request(self, req, resp):
+        ''' Start the request timer '''
+        req.context.started = time.perf_counter()
+
+    def process_resource(self, req, resp, resource, params):
+        ''' Count the request in flight once the route is known '''
+        req.context.inflight = (req.uri_template, req.method)
+        self.metrics.inc('dkr_http_requests_in_flight', req.context.inflight)
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        ''' Record the request count and latency '''
+        route = req.uri_template or 'unmatched'
+        if hasattr(req.context, 'inflight'):
+            self.metrics.inc('dkr_http_requests_in_flight', req.context.inflight, -1)
+        self.metrics.inc('dkr_http_requests_total', (route, req.method, f"{falcon.http_status_to_code(resp.status)}"))
+        self.metrics.observe('dkr_http_request_duration_seconds', (route, req.method),
+                             time.perf_counter() - req.context.started)
+
+    async def process_request_async(self, req, resp):
+        ''' Start the request timer, ASGI '''
+        self.process_request(req, resp)
+
+    async def process_resource_async(self, req, resp, resource, params):
+        ''' Count the request in flight once the route is known, ASGI '''
+        self.process_resource(req, resp, resource, params)
+
+    async def process_response_async(self, req, resp, resource, req_succeeded):
+        ''' Record the request count and latency, ASGI '''
+        self.process_response(req, resp, resource, req_succeeded)
+
+
+class RequestLog():
+    ''' Request id (X-Request-ID) and request logger, with a completion record carrying the duration.
+        The resources replace the logger with one at the loglevel in the request body
+    '''
+    def __init__(self, logger):
+        self.lgr = logger
+
+    def process_request(self, req, resp):
+        ''' Assign the request id, keeps an id set by the client or a proxy '''
+        req.context.reqid = req.get_header('X-Request-ID') or uuid.uuid4().hex
+        req.context.reqstart = time.perf_counter()
+        req.context.lgr = CustomAdapter(self.lgr, {'username': req.get_header('username') or 'system',
+                                                   'ip': f"{req.access_route}",
+                                                   'loglevel': None,
+                                                   'reqid': req.context.reqid})
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        ''' Return the request id and log the request completion '''
+        resp.set_header('X-Request-ID', req.context.reqid)
+        lgr = req.context.lgr
+        if lgr.isEnabledFor(logging.INFO):
+            duration = round((time.perf_counter() - req.context.reqstart) * 1000, 3)
+            lgr.info("%s %s %s", req.method, req.relative_uri, resp.status, extra={'duration': duration})
+
+    async def process_request_async(self, req, resp):
+        ''' Assign the request id, ASGI '''
+        self.process_request(req, resp)
+
+    async def process_response_async(self, req, resp, resource, req_succeeded):
+        ''' Return the request id and log the request completion, ASGI '''
+        self.process_response(req, resp, resource, req_succeeded)
+
+
 class RequireJSON():
     '''Request message and method/verb validator '''
+    OPENPATHS = ('/metrics',) # no username required, e.g. for the Prometheus scraper
+    STREAMPATHS = ('/logs', '/stats') # Server-Sent Events responses
+
     def __init__(self, logger, cfg):
         self.lgr = logger
         self.config = cfg
 
     def process_request(self, req, resp):
         '''Validator method for JSON body and allowed verb '''
-        self.lgr.warning(f"username header required: {self.config['HEADERTOKEN']}")
-        if self.config['HEADERTOKEN']:
+        lgr = req.context.lgr
+        if self.config['HEADERTOKEN'] and req.path not in self.OPENPATHS:
             uname = req.get_header('username')
-            self.lgr.error(f"Request by {uname}")
             if uname is None:
+                lgr.warning("username required in header")
                 raise falcon.HTTPUnauthorized(
                     title='username required in header',
                     description="username required in request header"
                 )
-        if not req.client_accepts_json:
-            self.lgr.error("Client doesn't accept JSON")
+        if not req.client_accepts_json and \
+           not (req.path.endswith(self.STREAMPATHS) and req.client_accepts('text/event-stream')):
+            lgr.error("Client doesn't accept JSON")
             raise falcon.HTTPNotAcceptable(
                 title='DKR-RJ01: API supports JSON encoded responses only.',
                 href='www.json.org')
         if req.method not in ('POST', 'GET', 'DELETE', 'OPTIONS', 'PUT'):
-            self.lgr.error(f"Invalid request method:{req.method}")
+            lgr.error("Invalid request method:%s", req.method)
             raise falcon.HTTPMethodNotAllowed(title="DKR-RJ02: Unsupported Method in API call",
                                               description='Trying to access unsupported Method.',
                                               allowed_methods=['POST', 'GET', 'DELETE'])
-        if req.method in ('POST', 'GET') and 'application/json' not in req.content_type \
+        if req.method in ('POST', 'GET') and 'application/json' not in (req.content_type or '') \
            and req.content_length not in (None, 0):
-            self.lgr.error(f"Invalid request content type:{req.content_type}")
+            lgr.error("Invalid request content type:%s", req.content_type)
             raise falcon.HTTPUnsupportedMediaType(
                     title='DKR-RJ03: API supports JSON encoded requests only.',
                     href='www.json.org')
 
-        if req.method in ('DELETE', 'PUT') and ('application/json' not in req.content_type \
+        if req.method in ('DELETE', 'PUT') and ('application/json' not in (req.content_type or '') \
                                                 or req.content_length in (None, 0)):
-            self.lgr.error(f"Invalid request content type:{req.content_type}")
+            lgr.error("Invalid request content type:%s", req.content_type)
             raise falcon.HTTPUnsupportedMediaType(
                     title='DKR-RJ04: API requires JSON encoded requests')
 
+    async def process_request_async(self, req, resp):
+        '''Validator method for JSON body and allowed verb, ASGI '''
+        self.process_request(req, resp)
+
 class JSONTranslator():
     '''Request JSON message validator '''
     def __init__(self, logger):
@@ -182,254 +1674,491 @@ class JSONTranslator():
 
     def process_request(self, req, resp):
         '''Validator method for JSON document '''
+        lgr = req.context.lgr
         if req.content_length in (None, 0):
             return
 
         req.context.doc = req.media
         if not req.context.doc:
-            self.lgr.info('Empty request Body')
+            lgr.info('Empty request Body')
         else:
-            self.lgr.debug(f"Request body: {req.context.doc}")
+            lgr.debug("Request body: %s", req.context.doc)
 
+    async def process_request_async(self, req, resp):
+        '''Validator method for JSON document, ASGI '''
+        lgr = req.context.lgr
+        if req.content_length in (None, 0):
+            return
+
+        req.context.doc = await req.get_media()
+        if not req.context.doc:
+            lgr.info('Empty request Body')
+        else:
+            lgr.debug("Request body: %s", req.context.doc)
 
     def process_response(self, req, resp, resource, req_succeeded):
-        ''' convert result to a json document'''
+        ''' convert result to a json document, with orjson when installed '''
         if not hasattr(resp.context, 'result'):
             return
-        resp.text = json.dumps(resp.context.result)
+        if orjson:
+            resp.data = orjson.dumps(resp.context.result)
+        else:
+            resp.data = json.dumps(resp.context.result).encode()
+
+    async def process_response_async(self, req, resp, resource, req_succeeded):
+        ''' convert result to a json document, ASGI '''
+        self.process_response(req, resp, resource, req_succeeded)
+
+
+class ResponseCache():
+    ''' Short lived cache of the GET /containers and /images results, keyed by route, user and query string.
+        Results are dropped as soon as a container or image changes. Responses carry an ETag, a request
+        with a matching If-None-Match gets 304 with no body. GET with a request body, e.g. a loglevel, isn't cached
+    '''
+    ROUTES = {'/': 'containers', '/containers': 'containers', '/images': 'images'}
+    SHARED = ('images',) # same result for every user
+
+    def __init__(self, logger, cfg, hosts):
+        self.lgr = logger
+        self.ttl = cfg['RESPCACHETTL']
+        self.maxsize = cfg['RESPCACHEMAX']
+        self._lock = threading.Lock()
+        self._entries = {} # (kind, user, query): [version, expiry, etag, body]
+        self._versions = dict.fromkeys(self.ROUTES.values(), 0)
+        for host in hosts:
+            # the image cache states show the images in use
+            host.cache.subscribe(lambda action, container: (self.invalidate('containers'), self.invalidate('images')))
+            host.cache.subscribe_images(lambda action, imgid: self.invalidate('images'))
+            host.images.subscribe(lambda ref: self.invalidate('images'))
+
+    def invalidate(self, kind):
+        ''' Drop the cached results of the kind, containers or images '''
+        with self._lock:
+            self._versions[kind] += 1
+
+    def _store(self, key, version, etag, body):
+        now = time.monotonic()
+        with self._lock:
+            if len(self._entries) >= self.maxsize:
+                self._entries = {each: entry for each, entry in self._entries.items()
+                                 if entry[0] == self._versions[each[0]] and entry[1] > now}
+                while len(self._entries) >= self.maxsize:
+                    del self._entries[next(iter(self._entries))]
+            self._entries[key] = [version, now + self.ttl, etag, body]
+
+    @staticmethod
+    def _reply(req, resp, etag, body):
+        ''' Set the ETag, 304 with no body when the client has the result already '''
+        resp.etag = etag
+        if req.if_none_match and (etag in req.if_none_match or '*' in req.if_none_match):
+            resp.status = falcon.HTTP_304
+            resp.data = None
+        else:
+            resp.data = body
+
+    def process_resource(self, req, resp, resource, params):
+        ''' Serve the result from the cache, the resource isn't called on a hit '''
+        kind = self.ROUTES.get(req.uri_template)
+        if kind is None or req.method != 'GET' or req.content_length:
+            return
+        key = (kind, None if kind in self.SHARED else req.get_header('username'), req.query_string)
+        with self._lock:
+            version = self._versions[kind]
+            entry = self._entries.get(key)
+        if entry and entry[0] == version and entry[1] > time.monotonic():
+            _METRICS.inc('dkr_response_cache_total', ('hit',))
+            self._reply(req, resp, entry[2], entry[3])
+            resp.complete = True
+            return
+        _METRICS.inc('dkr_response_cache_total', ('miss',))
+        # version as of before the result is built, a change while building makes the entry stale
+        req.context.cachekey = (key, version)
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        ''' Cache the serialized result '''
+        cachekey = getattr(req.context, 'cachekey', None)
+        if cachekey is None or not req_succeeded or falcon.http_status_to_code(resp.status) != 200 \
+           or resp.data is None:
+            return
+        etag = hashlib.blake2b(resp.data, digest_size=16).hexdigest()
+        if self.ttl:
+            self._store(*cachekey, etag, resp.data)
+        self._reply(req, resp, etag, resp.data)
+
+    async def process_resource_async(self, req, resp, resource, params):
+        ''' Serve the result from the cache, ASGI '''
+        self.process_resource(req, resp, resource, params)
+
+    async def process_response_async(self, req, resp, resource, req_succeeded):
+        ''' Cache the serialized result, ASGI '''
+        self.process_response(req, resp, resource, req_succeeded)
 
 
 class DkrInit():
     '''Initialize Docker, get list of running containers'''
-    def __init__(self, logger, cfg):
+    def __init__(self, logger, cfg, hosts):
         self.lgr = logger
+        self.hosts = hosts
         self.dflt_mnts = _allmnts()
-        self.dkr = docker.from_env()
         self.config = cfg
         self.config['MAXCPU'] = float(self.config['MAXCPU'])
-        self.config['host'] = socket.getfqdn()
-        self.config['ip'] = socket.gethostbyname(self.config['host'])
+        self.config['MAXMEM'] = _membytes(self.config['MAXMEM'])
         self.lgr.setLevel(self.config['LOGLEVEL'].upper())
-        self.username = None
 
-    def containers(self):
-        ''' Get list of running containers '''
-        self.dkr = docker.from_env()
-        rundct = {}
-        for each in self.dkr.containers.list(all=True):
-            rundct[each.name] = [each.short_id, each.attrs]
-        return rundct
+    def containers(self, username=None):
+        ''' Get list of running containers from the container caches of the hosts, only the user containers
+            when username is given. dict of name: [short_id, attrs, host]
+        '''
+        cntrs = {}
+        for host in self.hosts:
+            hostcntrs = host.cache.containers() if username is None else host.cache.usercontainers(username)
+            for name, (short_id, dkrattrs) in hostcntrs.items():
+                cntrs[name] = [short_id, dkrattrs, host]
+        return cntrs
+
+    def hostof(self, container):
+        ''' Host of a container object '''
+        return next(host for host in self.hosts if host.dkr is container.client)
+
+    def exists(self, name):
+        ''' A container with the name exists on any of the hosts '''
+        return any(host.cache.exists(name) for host in self.hosts)
 
 
 class DkrImages(DkrInit):
-    ''' Get list of available images'''
+    ''' Get list of available images, with the cache state: pinned (pre-pulled), in use (by a container),
+        cached (can be evicted) or pulling, and the last launch since startup
+        Docker API calls per request: GET 1 per host, the hosts are queried in parallel. 0 when served from the
+        response cache
+    '''
+    STATES = ('pinned', 'in use', 'cached')
+    FIELDS = ('tags', 'short id', 'size', 'created', 'cache', 'last used', 'hosts')
+
+    def __init__(self, logger, cfg, hosts):
+        super().__init__(logger, cfg, hosts)
+        self._fanout = ThreadPoolExecutor(max_workers=len(hosts), thread_name_prefix='dkrfanout')
+
+    def _images(self, host, filters=None):
+        ''' Image summaries of the host, images.list() inspects every image '''
+        try:
+            with _METRICS.timer('dkr_docker_call_duration_seconds', ('images.list',)):
+                return host, host.dkr.api.images(filters=filters)
+        except (docker.errors.DockerException, requests.exceptions.RequestException) as err:
+            if len(self.hosts) == 1:
+                raise
+            self.lgr.error("Images list of %s failed: %s", host.host, err)
+            return host, []
+
+    def image_info(self, summary, hosts, query):
+        ''' Image details from the image summary on the hosts, only the fields in the query '''
+        fields = query['fields']
+        def want(field):
+            return fields is None or field in fields
+        image = hosts[0].dkr.images.prepare_model(summary)
+        dct = {}
+        if want('tags'):
+            dct['tags'] = image.tags
+        if want('short id'):
+            dct['short id'] = image.short_id
+        if want('size'):
+            dct['size'] = f"{image.attrs['Size']/(1024*1024):,.2f}MB"
+        if want('created'):
+            dct['created'] = datetime.fromtimestamp(image.attrs['Created'], timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        if want('cache'):
+            dct['cache'] = self.state(image.id, hosts, query)
+        if want('last used'):
+            # latest launch on any of the hosts
+            lastuse = max((host.images.lastuse(image.id) or 0 for host in hosts), default=0)
+            dct['last used'] = datetime.fromtimestamp(lastuse, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ') \
+                               if lastuse else None
+        if want('hosts') and len(self.hosts) > 1:
+            dct['hosts'] = [host.host for host in hosts]
+        return dct
+
+    @staticmethod
+    def state(imgid, hosts, query):
+        ''' Strongest cache state of the image across the hosts, the host states are loaded once per request '''
+        states = query.setdefault('states', {})
+        for host in hosts:
+            if host not in states:
+                states[host] = host.images.states()
+        return min((states[host].get(imgid, 'cached') for host in hosts), key=DkrImages.STATES.index)
 
     @_customlgr
     def on_get(self, req, resp):
-        ''' Get container details for the user '''
+        ''' Get list of images. Query parameters, lists are comma separated:
+            limit and cursor, the next cursor is in the response when there are more images,
+            status:- cache states, image:- references, e.g. cdp_ml or nginx:1.*, fields:- image details to return
+        '''
+        lgr = req.context.lgr
         lst = []
-        self.lgr.info("received request for images list")
-        for each in self.dkr.images.list():
-            fsze = each.attrs['Size']/(1024*1024)
-            dct = {'tags': each.tags,
-                   'short id': each.short_id,
-                   'size': f"{fsze:,.2f}MB",
-                   'created': each.attrs['Created'] }
-            lst.append(dct)
-        self.lgr.debug(f"images list: {lst}")
+        lgr.info("received request for images list")
+        query = _listquery(req, self.FIELDS, self.STATES + ('pulling',))
+        # the image filter is passed to docker, the reference filter
+        images = functools.partial(self._images, filters={'reference': query['image']} if query['image'] else None)
+        if len(self.hosts) == 1:
+            hostimages = [images(self.hosts[0])]
+        else:
+            hostimages = self._fanout.map(images, self.hosts)
+        merged = {} # image id: [image summary, hosts]
+        for host, summaries in hostimages:
+            for each in summaries:
+                merged.setdefault(each['Id'], [each, []])[1].append(host)
+        ids = sorted(merged)
+        if query['status']:
+            ids = [imgid for imgid in ids if self.state(imgid, merged[imgid][1], query) in query['status']]
+        # details are built for the requested page only
+        page, cursor = _page(ids, query)
+        for imgid in page:
+            lst.append(self.image_info(*merged[imgid], query))
+        if cursor is None and (not query['status'] or 'pulling' in query['status']):
+            # pulls in progress, pre-pull or launch of an image not on the host, after the last page
+            for host in self.hosts:
+                for ref in host.images.pulling():
+                    if query['image'] and not _imagematch(ref, query['image']):
+                        continue
+                    dct = {'tags': [ref], 'cache': 'pulling'}
+                    if len(self.hosts) > 1:
+                        dct['hosts'] = [host.host]
+                    lst.append({key: val for key, val in dct.items()
+                                if query['fields'] is None or key in query['fields']})
+        lgr.debug("images list: %s", lst)
         resp.context.result = {'Available Images': lst}
+        if cursor:
+            resp.context.result['next cursor'] = cursor
         resp.status = falcon.HTTP_200
 
 
 class DkrLaunch(DkrInit):
-    ''' Docker run, stop or get list of containers for a user'''
-
-    def container_info(self, item):
-        ''' select few container attributes '''
-        dct = {'container name': item}
-        # if the application exposes a port, show the app url
-        port = 0
-        container = self.dkr.containers.get(item)
-        dkrattrs = container.attrs
-        try:
-            indx = dkrattrs['Args'].index('--port')
-            port = dkrattrs['Args'][indx + 1]
-        except ValueError:
-            self.lgr.debug("No port specified on docker run cmd")
-            # Get the values of network settings for exposedport
-            try:
-                for key, val in dkrattrs['NetworkSettings']['Ports'].items():
-                    self.lgr.debug(f"key: {key}, value:{val}")
-                    port = val[0]['HostPort']
-                    break
-            except (KeyError, TypeError):
-                port = 0
+    ''' Docker run, stop or get list of containers for a user
+        Docker API calls per request, independent of the number of containers and hosts:
+        GET 0 (container caches), PUT 2 (action, inspect), DELETE 1 (remove),
+        POST 4 (create, inspect, start, inspect), 6 if the image has to be pulled first.
+        PUT and DELETE call the host the container runs on, POST the least loaded host
+    '''
 
+    def __init__(self, logger, cfg, hosts, jobs):
+        super().__init__(logger, cfg, hosts)
+        self.jobs = jobs
+
+    # container details, from the container attrs
+    DETAILS = {'Status': lambda dkrattrs: dkrattrs['State']['Status'],
+               'Created': lambda dkrattrs: dkrattrs['Created'],
+               'StartedAt': lambda dkrattrs: dkrattrs['State']['StartedAt'],
+               'Image': lambda dkrattrs: dkrattrs['Config']['Image'],
+               'Memory': lambda dkrattrs: f"{dkrattrs['HostConfig']['Memory']/(1024*1024):,.0f}MB",
+               'Cpus': lambda dkrattrs: dkrattrs['HostConfig']['NanoCpus']/NANOCPUS,
+               'Mounts': lambda dkrattrs: dkrattrs['Mounts']}
+    FIELDS = ('container name', 'application url', 'container id', 'container details') + \
+             tuple(key.lower() for key in DETAILS)
+    STATUSES = ('created', 'running', 'paused', 'restarting', 'removing', 'exited', 'dead')
+
+    def container_info(self, item, short_id, dkrattrs, host, fields=None):
+        ''' select few container attributes from already fetched container attrs, only the fields given '''
+        def want(field):
+            return fields is None or field in fields
+        dct = {}
+        if want('container name'):
+            dct['container name'] = item
+        # if the application exposes a port, show the app url on the host the container runs on
+        port = _cntrport(dkrattrs) if want('application url') else None
         if port:
-            dct['application url'] =  f"{self.config['host']}:{port}"
-        dct['container id'] = container.short_id
-        # Show select few container details
-        msze = dkrattrs['HostConfig']['Memory']/(1024*1024)
-        cpus = dkrattrs['HostConfig']['NanoCpus']/1000000000
-        dct['container details'] = {'Status': dkrattrs['State']['Status'],
-                                    'Created': dkrattrs['Created'],
-                                    'StartedAt': dkrattrs['State']['StartedAt'],
-                                    'Image': dkrattrs['Config']['Image'],
-                                    'Memory': f"{msze:,.0f}MB",
-                                    'Cpus': cpus,
-                                    'Mounts': dkrattrs['Mounts']}
+            dct['application url'] =  f"{host.host}:{port}"
+        if want('container id'):
+            dct['container id'] = short_id
+        # Show select few container details, all of them with container details
+        details = {key: detail(dkrattrs) for key, detail in self.DETAILS.items()
+                   if want('container details') or key.lower() in fields}
+        if details:
+            dct['container details'] = details
         return dct
 
-    def _getcontainer(self, reqmsg):
+    def _getcontainer(self, req):
         ''' Get the container object for start, stop or delete'''
+        reqmsg = req.context.doc
+        lgr = req.context.lgr
+        username = req.context.username
         cname = None
         cid = None
         cntr = None
-        self.lgr.debug(f"Request document {reqmsg}")
+        lgr.debug("Request document %s", reqmsg)
         try:
             cname = reqmsg['container name']
-            self.lgr.debug(f"Container : {cname}")
+            lgr.debug("Container : %s", cname)
         except (AttributeError, KeyError):
-            self.lgr.debug("No container name specified")
+            lgr.debug("No container name specified")
             try:
                 cid = reqmsg['container id']
-                self.lgr.debug(f"Container id: {cid}")
+                lgr.debug("Container id: %s", cid)
             except (AttributeError, KeyError):
-                self.lgr.debug("No container id specified")
-        runningcs = self.containers()
-        self.lgr.debug(f"Running containers {runningcs}")
-        for each in runningcs :
-            self.lgr.info(f"container Name:{each}  Id: {runningcs[each][0]}")
-            # API short_id length can be lesser than what the user passes in the API, hence startswith
-            if each.startswith(self.username):
-                if each == cname or \
-                   (cid and (cid.startswith(runningcs[each][0]) or
-                             runningcs[each][0].startswith(cid)
-                            )
-                   ):
-                    cntr = self.dkr.containers.get(each)
-                    self.lgr.debug(f"Got container Name:{each}  Id: {runningcs[each][0]}")
-                    break
+                lgr.debug("No container id specified")
+        cntr = self.resolve(username, [cname] if cname else [], [cid] if cid else []).get(cname or cid)
+        if cntr:
+            lgr.debug("Got container Name:%s  Id: %s", cntr.name, cntr.short_id)
         return cntr
 
+    def resolve(self, username, names=(), ids=(), minid=1):
+        ''' Get the user containers by name or id in a single pass over the cached containers.
+            Ids shorter than minid are not matched, an id prefix matching more than one container is not matched.
+            Returns dict of the requested name or id: container object
+        '''
+        byname = {}
+        byid = {} # id: containers the id prefix matches
+        names = set(names)
+        ids = [cid for cid in ids if len(cid) >= max(minid, 1)]
+        for each, (short_id, dkrattrs, host) in self.containers(username).items():
+            # Build the container object from the cached attrs, no docker API call
+            if each in names:
+                byname[each] = host.dkr.containers.prepare_model(dkrattrs)
+            # API short_id length can be lesser than what the user passes in the API, hence startswith
+            for cid in ids:
+                if cid.startswith(short_id) or short_id.startswith(cid):
+                    byid.setdefault(cid, []).append(host.dkr.containers.prepare_model(dkrattrs))
+        found = {cid: cntrs[0] for cid, cntrs in byid.items() if len(cntrs) == 1}
+        # a container name takes precedence over an id prefix
+        found.update(byname)
+        return found
+
+    def action(self, container, action, lgr):
+        ''' Perform start/stop/restart/remove on the container, returns http status and result '''
+        host = self.hostof(container)
+        try:
+            if action == 'remove':
+                container.remove(force=True)
+                host.cache.discard(container.id)
+                return falcon.HTTP_200, {'Delete successful':
+                                         f"Container name:{container.name}, id:{container.short_id}"}
+            if action == 'start':
+                container.start()
+            elif action == 'stop':
+                container.stop()
+            elif action == 'restart':
+                container.restart()
+            # Get the updated container information
+            container.reload()
+        except docker.errors.NotFound:
+            # container launched with remove=True is gone once stopped
+            host.cache.discard(container.id)
+            return falcon.HTTP_200, {f"Action {action} successful":
+                                     f"Container name:{container.name}, id:{container.short_id} removed on stop"}
+        except docker.errors.APIError as err:
+            lgr.debug("failed to perform %s due to %s", action, err)
+            return falcon.HTTP_412, {f"Action {action} failed": f"{err.explanation}"}
+        host.cache.update(container)
+        return falcon.HTTP_200, {f"Action {action} successful":
+                                 self.container_info(container.name, container.short_id, container.attrs, host)}
+
     @_customlgr
     def on_get(self, req, resp):
-        ''' Get list of user containers '''
+        ''' Get list of user containers, by name. Query parameters, lists are comma separated:
+            limit and cursor, the next cursor is in the response when there are more containers,
+            status:- container states, image:- image references, e.g. cdp_ml or nginx:1.*,
+            fields:- container fields or container details to return, e.g. container name,status
+        '''
+        lgr = req.context.lgr
+        username = req.context.username
         lst = []
-        self.lgr.info("received request for containers list")
-        for each in self.containers():
-            self.lgr.debug(f"container name: {each}")
-            if each.startswith(self.username):
-                lst.append(self.container_info(each))
-        self.lgr.debug(f"container list: {lst}")
+        lgr.info("received request for containers list")
+        query = _listquery(req, self.FIELDS, self.STATUSES)
+        cntrs = self.containers(username)
+        # filtered on the cached attrs, details are built for the requested page only
+        names = sorted(name for name, (short_id, dkrattrs, host) in cntrs.items()
+                       if (not query['status'] or dkrattrs['State']['Status'] in query['status'])
+                       and (not query['image'] or _imagematch(dkrattrs['Config']['Image'], query['image'])))
+        page, cursor = _page(names, query)
+        for each in page:
+            lgr.debug("container name: %s", each)
+            lst.append(self.container_info(each, *cntrs[each], query['fields']))
+        lgr.debug("container list: %s", lst)
         resp.context.result = {'Running Containers': lst}
+        if cursor:
+            resp.context.result['next cursor'] = cursor
         resp.status = falcon.HTTP_200
 
     @_customlgr
     def on_put(self, req, resp):
         ''' Perform start/stop/retart on user container '''
+        lgr = req.context.lgr
+        username = req.context.username
+        container = None
         try:
             action = req.context.doc['action']
-            self.lgr.debug(f"Container action: {action}")
+            lgr.debug("Container action: %s", action)
         except (AttributeError, KeyError):
             action = None
-            self.lgr.debug("No action specified")
+            lgr.debug("No action specified")
         else:
-            container = self._getcontainer(req.context.doc)
+            container = self._getcontainer(req)
         #Default message
         resp.context.result = {f"Action {action} failed":
-                               f"Invalid action or invalid container or container doesn't belong to user {self.username}"}
+                               f"Invalid action or invalid container or container doesn't belong to user {username}"}
         resp.status = falcon.HTTP_412
         if container and action and action.lower() in ('start', 'stop', 'restart'):
-            try:
-                if action.lower() == 'start':
-                    container.start()
-                elif action.lower() == 'stop':
-                    container.stop()
-                elif action.lower() == 'restart':
-                    container.restart()
-            except docker.errors.APIError as err:
-                self.lgr.debug(f"failed to perform {action} due to {err}")
-            else:
-                # Get the updated container information
-                container = self.dkr.containers.get(container.name)
-                resp.context.result = {f"Action {action} successful": self.container_info(container.name)}
-                resp.status = falcon.HTTP_200
+            resp.status, resp.context.result = self.action(container, action.lower(), lgr)
 
     @_customlgr
     def on_delete(self, req, resp):
         ''' Remove/delete the user container '''
-        container = self._getcontainer(req.context.doc)
+        username = req.context.username
+        container = self._getcontainer(req)
         if container:
-            container.remove(force=True)
-            resp.context.result = {'Delete successful':
-                                   f"Container name:{container.name}, id:{container.short_id}"}
-            resp.status = falcon.HTTP_200
+            resp.status, resp.context.result = self.action(container, 'remove', req.context.lgr)
         else:
             resp.context.result = {'Delete failed':
-                                   f"Invalid container or doesn't belong to user {self.username}"}
+                                   f"Invalid container or doesn't belong to user {username}"}
             resp.status = falcon.HTTP_412
 
 
-    @_customlgr
-    def on_post(self, req, resp):
-        ''' Handler for launching containers '''
+    def _launchreq(self, req, resp):
+        ''' Validate the launch request, returns image, command and containers.run arguments.
+            None when the request can't be launched, with resp set
+        '''
+        lgr = req.context.lgr
+        username = req.context.username
         post_dct = {}
         cmdlst = None
 
-        # Container names are of the form user, user1...
-        ulst = [each for each in self.containers() if each.startswith(self.username)]
-        self.lgr.debug(f"User Container list: {ulst}")
+        # Include launches still queued
+        ulst = list(self.containers(username)) + self.jobs.pending(username)
+        lgr.debug("User Container list: %s", ulst)
         if len(ulst) >= self.config['MAX_PER_USER']:
-            self.lgr.error("Will not launch new container, exceeds user limit")
+            lgr.error("Will not launch new container, exceeds user limit")
             resp.context.result = {"condition": "Per User max container limit exceeded"}
             resp.status = falcon.HTTP_412
-            return
+            return None
         try:
             image = req.context.doc.get('image', self.config['DEFAULTIMG'])
         except AttributeError:
             image = self.config['DEFAULTIMG']
-            self.lgr.info("No image specified, default {post_dct['image']} used")
+            lgr.info("No image specified, default %s used", image)
 
         # Get the remove option, default remove container on stop
         try:
             post_dct['remove'] = req.context.doc['remove']
-            self.lgr.debug(f"Remove: {post_dct['remove']}")
+            lgr.debug("Remove: %s", post_dct['remove'])
             if post_dct['remove'] not in (True, False):
                 post_dct['remove'] = True
         except (AttributeError, KeyError):
-            self.lgr.info("No remove option specified")
+            lgr.info("No remove option specified")
             post_dct['remove'] = True
-        self.lgr.debug(f"Final value of Remove: {post_dct['remove']}")
+        lgr.debug("Final value of Remove: %s", post_dct['remove'])
 
         # Get the command line arguments
         try:
             cmdlst = req.context.doc['command']
         except (AttributeError, KeyError):
-            self.lgr.info("No command line args specified")
+            lgr.info("No command line args specified")
 
         # Get the network mode, For CDP ML image network_mode should be host
         if image == self.config['DEFAULTIMG']:
             post_dct['network_mode'] = 'host'
             post_dct['mounts'] = self.dflt_mnts
-            for prt in range(self.config['MINPRT'], self.config['MAXPRT']):
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as skt:
-                    try:
-                        skt.settimeout(0.25)
-                        skt.connect((self.config['ip'], prt))
-                    except ConnectionRefusedError:
-                        port = prt
-                        break
-            if isinstance(cmdlst, list):
-                cmdlst = ["start-process.sh", "--port", str(port)] + cmdlst
-            else:
-                cmdlst = ["start-process.sh", "--port", str(port)]
         else:
             # Get the mounts
             try:
                 post_dct['mounts'] = req.context.doc['mounts']
             except (AttributeError, KeyError):
-                self.lgr.info("No mounts specified in the request")
+                lgr.info("No mounts specified in the request")
 
             # Get network mode and the port
             try:
@@ -443,70 +2172,479 @@ class DkrLaunch(DkrInit):
                 try:
                     post_dct['ports'] = req.context.doc['ports']
                 except (AttributeError, KeyError):
-                    self.lgr.info("No port specified in the request")
+                    lgr.info("No port specified in the request")
 
+        post_dct['nano_cpus'] = DEFAULTCPU # default 1 CPU
         try:
             cpus = req.context.doc['cpus']
-            if isinstance(cpus, (float, int)):
-                if cpus > self.config['MAXCPU']: # CPU max hard limit
-                    post_dct['nano_cpus'] = 1000000000 * self.config['MAXCPU']
-                else:
-                    post_dct['nano_cpus'] = cpus*1000000000
-        except (AttributeError, ValueError, KeyError):
-            post_dct['nano_cpus'] = 1000000000 # default 1 CPU
+            if isinstance(cpus, (float, int)) and not isinstance(cpus, bool) and cpus > 0:
+                # CPU max hard limit, docker requires an integer
+                post_dct['nano_cpus'] = int(min(cpus, self.config['MAXCPU']) * NANOCPUS)
+        except (AttributeError, KeyError):
+            pass
 
         try:
-            post_dct['mem_limit'] = req.context.doc['memory']
-            #convert memory request to bytes, verify against max memory limit config
-            memdct = {'b':1, 'k':1024, 'm':1048576, 'g':1073741824}
-            maxmem = memdct[self.config['MAXMEM'][-1]]*float(self.config['MAXMEM'][:-1])
-            if post_dct['mem_limit'][-1] not in memdct:
-                post_dct['mem_limit'] = '512m'
-            elif memdct[post_dct['mem_limit'][-1]]*float(post_dct['mem_limit'][:-1]) > maxmem:
-                post_dct['mem_limit'] = self.config['MAXMEM']
+            # memory in bytes, verify against max memory limit config
+            post_dct['mem_limit'] = min(_membytes(req.context.doc['memory']), self.config['MAXMEM'])
         except (AttributeError, ValueError, KeyError):
-            post_dct['mem_limit'] = '512m' # default 512MB
+            post_dct['mem_limit'] = DEFAULTMEM # default 512MB
+
+
+        # Container names are of the form user, user1..., first name not in use on the hosts or by a queued launch
+        post_dct['name'] = username
+        cntr = 0
+        while self.exists(post_dct['name']) or post_dct['name'] in ulst:
+            cntr += 1
+            post_dct['name'] = f"{username}{cntr}"
+        post_dct['labels'] = {OWNERLABEL: username}
+        lgr.debug("Container image: %s, command: %s", image, cmdlst)
+        return image, cmdlst, post_dct
+
+    def place(self, image):
+        ''' Hosts in placement order, least loaded first. Hosts with the image first and, for the default image,
+            hosts with a free port first
+        '''
+        hosts = sorted(self.hosts, key=lambda host: host.load())
+        if len(hosts) > 1:
+            # hosts with the image first, a pull takes minutes
+            hosts.sort(key=lambda host: not host.images.present(image))
+        if image == self.config['DEFAULTIMG']:
+            hosts.sort(key=lambda host: not host.ports.free())
+        return hosts
 
+    def _admit(self, hosts, post_dct):
+        ''' Reserve CPU and memory on the first host in placement order with room. When none has room,
+            wait for room on the least loaded host. Returns host and admission ticket, None if not admitted
+        '''
+        request = (post_dct['labels'][OWNERLABEL], post_dct['nano_cpus'], post_dct['mem_limit'])
+        if len(hosts) > 1:
+            for host in hosts:
+                ticket = host.admission.admit(*request, wait=0)
+                if ticket:
+                    return host, ticket
+        return hosts[0], hosts[0].admission.admit(*request)
 
-        if len(ulst) == 0:
-            post_dct['name'] = self.username
+    def _launch(self, image, cmdlst, post_dct, lgr, progress=None, pullhost=None):
+        ''' Launch the container on the least loaded host, from a warm pool when possible. A missing image is pulled
+            first, reported with progress(status, condition) on a launch job. pullhost, the host the pull was started
+            on, is placed first. Returns http status and result
+        '''
+        container = None
+        port = None
+        hosts = self.place(image)
+        if pullhost is not None:
+            hosts = [pullhost] + [each for each in hosts if each is not pullhost]
+        host = hosts[0]
+        if host.pool.match(image, cmdlst, post_dct):
+            # least loaded host with an idle pool container
+            host = next((each for each in hosts if each.pool.info()['idle']), host)
+            container = host.pool.take(post_dct['labels'][OWNERLABEL], self.exists)
+        if container is None and not host.images.present(image):
+            # pull before the CPU, memory and port are reserved
+            lgr.info("Launch of %s waiting on the pull of %s on %s", post_dct['name'], image, host.host)
+            if progress:
+                progress('pulling', f"Waiting on the pull of image {image}")
+            host.images.pull(image).result()
+            if progress:
+                progress('running')
+            # admit only on hosts with the image, not on another host that would pull it again
+            hosts = [each for each in hosts if each.images.present(image)] or [host]
+        if container is None:
+            host, ticket = self._admit(hosts, post_dct)
+            if ticket is None:
+                lgr.error("Will not launch new container, host CPU or memory fully reserved")
+                return falcon.HTTP_503, {"condition": "Host CPU or memory fully reserved, try again later"}
+            try:
+                if image == self.config['DEFAULTIMG']:
+                    with _METRICS.timer('dkr_port_select_duration_seconds'):
+                        port = host.ports.allocate()
+                    if port is None:
+                        lgr.error("Will not launch new container, no free port")
+                        return falcon.HTTP_503, {"condition": "No free port available on the host"}
+                    cmdlst = ["start-process.sh", "--port", str(port)] + (cmdlst if isinstance(cmdlst, list) else [])
+                post_dct = _launchargs(**post_dct)
+                lgr.debug("Launching container on %s with the arguments: %s", host.host, post_dct)
+                try:
+                    with _METRICS.timer('dkr_docker_call_duration_seconds', ('containers.run',)):
+                        container = host.dkr.containers.run(image, cmdlst, **post_dct)
+                except docker.errors.DockerException:
+                    if port:
+                        host.ports.release(port)
+                    raise
+                # run() returns the container as inspected before start, reload for the running state
+                container.reload()
+                host.cache.update(container)
+            finally:
+                host.admission.release(ticket)
         else:
-            cntr = max(each.strip(self.username) for each in ulst)
-            if cntr:
-                cntr = int(cntr) + 1
+            lgr.info("Container %s handed out from the warm pool of %s", container.name, host.host)
+        host.images.touch(container.attrs['Image'])
+        cntrdetails = self.container_info(container.name, container.short_id, container.attrs, host)
+        lgr.debug("Container launched: %s", cntrdetails)
+        return falcon.HTTP_201, cntrdetails
+
+    @_customlgr
+    def on_post(self, req, resp):
+        ''' Handler for launching containers. With async true in the body, or when the image has to be pulled,
+            the launch is queued and the job id returned, the job status is available on /jobs/{job id}
+        '''
+        lgr = req.context.lgr
+        launch = self._launchreq(req, resp)
+        if launch is None:
+            return
+        image, cmdlst, post_dct = launch
+        try:
+            runasync = req.context.doc.get('async', False) is True
+        except AttributeError:
+            runasync = False
+        pullhost = None
+        pulling = not any(host.images.present(image) for host in self.hosts)
+        if pulling:
+            # a pull takes minutes, start it now and queue the launch instead of holding the request
+            pullhost = self.place(image)[0]
+            pullhost.images.pull(image)
+            lgr.info("Image %s not on the hosts, launch of %s queued until it is pulled", image, post_dct['name'])
+            runasync = True
+        if not runasync:
+            resp.status, resp.context.result = self._launch(image, cmdlst, post_dct, lgr)
+            if resp.status == falcon.HTTP_503:
+                resp.retry_after = 30
+            return
+        job = self.jobs.submit(req.context.username, post_dct['name'],
+                               functools.partial(self._launch, image, cmdlst, post_dct, lgr, pullhost=pullhost))
+        if job is None:
+            lgr.error("Will not queue the launch, launch queue is full")
+            resp.context.result = {"condition": "Too many launches queued, try again later"}
+            resp.status = falcon.HTTP_429
+            resp.retry_after = 30
+            return
+        lgr.info("Launch of %s queued as job %s", post_dct['name'], job['job id'])
+        if pulling:
+            job['condition'] = f"Waiting on the pull of image {image}"
+        resp.context.result = job
+        resp.location = f"/jobs/{job['job id']}"
+        resp.status = falcon.HTTP_202
+
+
+class DkrPool():
+    ''' Warm pool statistics '''
+    def __init__(self, hosts):
+        self.hosts = hosts
+
+    @_customlgr
+    def on_get(self, req, resp):
+        ''' Get warm pool size and hit/miss counts, totals and per host with several hosts '''
+        pools = {host.host: host.pool.info() for host in self.hosts}
+        total = {}
+        for info in pools.values():
+            for key, val in info.items():
+                total[key] = total.get(key, 0) + val
+        if len(self.hosts) > 1:
+            total['hosts'] = pools
+        resp.context.result = {'Warm Pool': total}
+        resp.status = falcon.HTTP_200
+
+
+class DkrBulk():
+    ''' Start, stop, restart or remove a list of user containers. The containers are resolved in one lookup,
+        the docker calls run in parallel on BULKWORKERS threads
+    '''
+    ACTIONS = ('start', 'stop', 'restart', 'remove')
+    MINID = 4 # shortest container id prefix matched
+
+    def __init__(self, launcher, cfg):
+        self.launcher = launcher
+        self.maxitems = cfg['BULKMAX']
+        self._executor = ThreadPoolExecutor(max_workers=cfg['BULKWORKERS'], thread_name_prefix='dkrbulk')
+
+    @_customlgr
+    def on_post(self, req, resp):
+        ''' Perform the action on the list of containers, names or ids, returns per container results '''
+        lgr = req.context.lgr
+        username = req.context.username
+        try:
+            action = req.context.doc['action'].lower()
+            refs = req.context.doc['containers']
+        except (AttributeError, KeyError, TypeError):
+            action = None
+            refs = []
+        if not isinstance(refs, list) or not all(isinstance(each, str) and each for each in refs):
+            refs = []
+        if action not in self.ACTIONS or not refs or len(refs) > self.maxitems:
+            resp.context.result = {"Bulk action failed":
+                                   f"action must be one of {', '.join(self.ACTIONS)}, "
+                                   f"containers a list of 1 to {self.maxitems} container names or ids "
+                                   f"(ids at least {self.MINID} characters)"}
+            resp.status = falcon.HTTP_412
+            return
+        found = self.launcher.resolve(username, refs, refs, self.MINID)
+        lgr.info("Bulk %s on %s of %s containers", action, len(found), len(refs))
+        futures = {} # container id: future, a container listed twice is acted on once
+        for ref in refs:
+            if ref in found and found[ref].id not in futures:
+                futures[found[ref].id] = self._executor.submit(self.launcher.action, found[ref], action, lgr)
+        results = []
+        for ref in refs:
+            if ref in found:
+                status, result = futures[found[ref].id].result()
             else:
-                cntr = 1
-            post_dct['name'] = f"{self.username}{cntr}"
-        self.lgr.debug(f"Container image: {image}, command: {cmdlst}")
-        post_dct['log_config'] = docker.types.LogConfig(config={'mode': 'non-blocking',
-                                                                'max-size': '10m',
-                                                                'max-file': '3',
-                                                                'max-buffer-size': '4m'})
-        post_dct['mem_swappiness'] = 0
-        post_dct['init'] = True
-        post_dct['detach'] = True
-        post_dct['tty'] = True
-        self.lgr.debug(f"Launching container with the arguments: {post_dct}")
-        container = self.dkr.containers.run(image, cmdlst, **post_dct)
-        cntrdetails = self.container_info(container.name)
-        self.lgr.debug(f"Container launched: {cntrdetails}")
-        resp.context.result = cntrdetails
-        resp.status = falcon.HTTP_201
+                status = falcon.HTTP_412
+                result = {f"Action {action} failed": f"Invalid container or doesn't belong to user {username}"}
+            results.append({'container': ref, 'status': status, 'result': result})
+        resp.context.result = {f"Bulk {action}": results}
+        resp.status = falcon.HTTP_200
+
 
+class DkrReaper():
+    ''' Idle reaper activity '''
+    def __init__(self, reaper):
+        self.reaper = reaper
 
+    @_customlgr
+    def on_get(self, req, resp):
+        ''' Idle containers of the user and the containers reaped, all users for the system user '''
+        username = req.context.username
+        resp.context.result = {'Idle Reaper': self.reaper.info(None if username == 'system' else username)}
+        resp.status = falcon.HTTP_200
+
+
+class DkrJobs():
+    ''' Asynchronous launch job status '''
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    @_customlgr
+    def on_get(self, req, resp, jobid):
+        ''' Get job status, with the container details once the launch succeeded '''
+        job = self.jobs.get(jobid)
+        if job is None or job['username'] != req.context.username:
+            resp.context.result = {'Job failed': f"Invalid job or doesn't belong to user {req.context.username}"}
+            resp.status = falcon.HTTP_404
+            return
+        resp.context.result = job
+        resp.status = falcon.HTTP_200
+
+
+class DkrMetrics():
+    ''' Prometheus metrics, scrape time gauges are refreshed by collect() '''
+    def __init__(self, metrics, collect):
+        self.metrics = metrics
+        self.collect = collect
+
+    def on_get(self, req, resp):
+        ''' Get all metrics in the Prometheus text format '''
+        self.collect()
+        resp.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        resp.text = self.metrics.render()
+        resp.status = falcon.HTTP_200
+
+
+class DkrStreams():
+    ''' Logs and stats of a user container streamed as Server-Sent Events. Streams are limited in total
+        and per user, each open stream holds a stream thread reading from docker
+    '''
+    KINDS = ('logs', 'stats')
+
+    def __init__(self, launcher, cfg):
+        self.launcher = launcher
+        self.config = cfg
+        self._lock = threading.Lock()
+        self._users = {} # username: open streams
+        self._pumps = ThreadPoolExecutor(max_workers=cfg['STREAMMAX'], thread_name_prefix='dkrstream')
+
+    def _release(self, username):
+        with self._lock:
+            self._users[username] -= 1
+            if not self._users[username]:
+                del self._users[username]
+
+    def _open(self, req, resp, name, kind):
+        ''' Start the stream of a user container, None with resp set if it isn't the user's container '''
+        username = req.context.username
+        container = self.launcher.resolve(username, [name], [name]).get(name)
+        if container is None:
+            resp.context.result = {f"Container {kind} failed": f"Invalid container or doesn't belong to user {username}"}
+            resp.status = falcon.HTTP_412
+            return None
+        with self._lock:
+            if sum(self._users.values()) >= self.config['STREAMMAX'] or \
+               self._users.get(username, 0) >= self.config['STREAMPERUSER']:
+                raise falcon.HTTPServiceUnavailable(
+                    title='DKR-ST01: Too many streams',
+                    description=f"Too many open logs/stats streams, at most {self.config['STREAMPERUSER']} per user",
+                    retry_after=30)
+            self._users[username] = self._users.get(username, 0) + 1
+        req.context.lgr.info("Streaming %s of %s", kind, container.name)
+        stream = ContainerStream(container, kind, self.config, functools.partial(self._release, username))
+        self._pumps.submit(stream.pump)
+        resp.set_header('Cache-Control', 'no-cache')
+        return stream
+
+    @_customlgr
+    def on_get_logs(self, req, resp, name):
+        ''' Follow the container logs, one event per line '''
+        resp.stream = self._open(req, resp, name, 'logs')
+        if resp.stream:
+            resp.content_type = 'text/event-stream'
+
+    @_customlgr
+    def on_get_stats(self, req, resp, name):
+        ''' Container stats, one event per second '''
+        resp.stream = self._open(req, resp, name, 'stats')
+        if resp.stream:
+            resp.content_type = 'text/event-stream'
+
+
+class AsyncDkrStreams(DkrStreams):
+    ''' DkrStreams for the ASGI app, events are sent from the event loop without holding a request thread '''
+    @_customlgr
+    async def on_get_logs(self, req, resp, name):
+        ''' Follow the container logs, one event per line '''
+        stream = self._open(req, resp, name, 'logs')
+        if stream:
+            resp.sse = stream.sse()
+
+    @_customlgr
+    async def on_get_stats(self, req, resp, name):
+        ''' Container stats, one event per second '''
+        stream = self._open(req, resp, name, 'stats')
+        if stream:
+            resp.sse = stream.sse()
+
+
+class AsyncResource():
+    ''' ASGI wrapper for a resource. The blocking responders run in the thread pool, each method
+        is limited to a number of concurrent requests and a timeout, so that slow launches don't
+        hold up the fast GETs
+    '''
+    def __init__(self, resource, executor, limits, timeout):
+        self.executor = executor
+        self.timeout = timeout
+        self._limits = {}
+        for method in ('get', 'put', 'post', 'delete'):
+            responder = getattr(resource, f"on_{method}", None)
+            if responder:
+                self._limits[method] = asyncio.Semaphore(limits[method.upper()])
+                setattr(self, f"on_{method}", self._responder(method, responder))
+
+    def _responder(self, method, responder):
+        async def inner(req, resp, **kwargs):
+            deadline = time.monotonic() + self.timeout
+            sem = self._limits[method]
+            try:
+                await asyncio.wait_for(sem.acquire(), self.timeout)
+            except asyncio.TimeoutError:
+                raise falcon.HTTPServiceUnavailable(
+                    title='DKR-AS01: Too many concurrent requests',
+                    description=f"Too many concurrent {method.upper()} requests, try again later",
+                    retry_after=self.timeout)
+            # The semaphore is held until the thread is done, even if the request times out
+            fut = asyncio.get_running_loop().run_in_executor(
+                self.executor, functools.partial(responder, req, resp, **kwargs))
+            fut.add_done_callback(lambda _: sem.release())
+            try:
+                await asyncio.wait_for(asyncio.shield(fut), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                raise falcon.HTTPGatewayTimeout(
+                    title='DKR-AS02: Request timed out',
+                    description=f"{method.upper()} did not complete in {self.timeout} seconds")
+        return inner
+
+    @classmethod
+    def routes(cls, app, routes, cfg):
+        ''' Add the routes to the ASGI app. The thread pool is sized to the sum of the per method limits,
+            so a request that gets past its limit always has a thread
+        '''
+        wrapped = {}
+        workers = 0
+        for resource in routes.values():
+            if id(resource) not in wrapped:
+                workers += sum(lmt for mthd, lmt in cfg['ASGILIMITS'].items()
+                               if hasattr(resource, f"on_{mthd.lower()}"))
+                wrapped[id(resource)] = resource
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dkrasgi')
+        for rid, resource in wrapped.items():
+            wrapped[rid] = cls(resource, executor, cfg['ASGILIMITS'], cfg['ASGITIMEOUT'])
+        for route, resource in routes.items():
+            app.add_route(route, wrapped[id(resource)])
+
+
+# the local docker engine (DOCKER_HOST) when no hosts are configured
+_MOUNTS = _allmnts()
+_HOSTS = [DkrHost(_LOGGER, _CFG, each, _MOUNTS) for each in _CFG.get('DKRHOSTS') or [{}]]
+_RESPCACHE = ResponseCache(_LOGGER, _CFG, _HOSTS)
+
+# ResponseCache before JSONTranslator, its process_response runs after the result is serialized
 app = falcon.App(middleware=[
+    RequestLog(_LOGGER),
+    MetricsMiddleware(_METRICS),
     RequireJSON(_LOGGER, _CFG),
+    _RESPCACHE,
     JSONTranslator(_LOGGER),
 ])
 
+dkrimages = DkrImages(_LOGGER, _CFG, _HOSTS)
+_JOBS = LaunchJobs(_LOGGER, _CFG)
+dkrsrvr = DkrLaunch(_LOGGER, _CFG, _HOSTS, _JOBS)
+_REAPER = IdleReaper(_LOGGER, _CFG, dkrsrvr)
+
+
+
+def _collect():
+    ''' Refresh the scrape time gauges '''
+    owners = {}
+    for host in _HOSTS:
+        for user, cnt in host.cache.owners().items():
+            owners[(user,)] = owners.get((user,), 0) + cnt
+    _METRICS.replace('dkr_user_containers', owners)
+    _METRICS.replace('dkr_ports_in_use', {(): sum(host.ports.inuse() for host in _HOSTS)})
+    pools = [host.pool.info() for host in _HOSTS]
+    _METRICS.replace('dkr_warm_pool_idle', {(): sum(pool['idle'] for pool in pools)})
+    _METRICS.replace('dkr_warm_pool_requests_total', {('hit',): sum(pool['hits'] for pool in pools),
+                                                      ('miss',): sum(pool['misses'] for pool in pools)})
+    admissions = [host.admission.info() for host in _HOSTS]
+    _METRICS.replace('dkr_reserved_nano_cpus', {(): sum(adm['cpus'] for adm in admissions)})
+    _METRICS.replace('dkr_reserved_memory_bytes', {(): sum(adm['memory'] for adm in admissions)})
+    _METRICS.replace('dkr_admission_waiting', {(): sum(adm['waiting'] for adm in admissions)})
+    _METRICS.replace('dkr_image_disk_bytes', {(): sum(host.images.disk for host in _HOSTS)})
+
+_ROUTES = {'/images': dkrimages,
+           '/metrics': DkrMetrics(_METRICS, _collect),
+           '/pool': DkrPool(_HOSTS),
+           '/reaper': DkrReaper(_REAPER),
+           '/jobs/{jobid}': DkrJobs(_JOBS),
+           '/': dkrsrvr,
+           '/containers': dkrsrvr,
+           '/containers/bulk': DkrBulk(dkrsrvr, _CFG)}
+for _route, _resource in _ROUTES.items():
+    app.add_route(_route, _resource)
+_STREAMS = DkrStreams(dkrsrvr, _CFG)
+for _kind in DkrStreams.KINDS:
+    app.add_route(f"/containers/{{name}}/{_kind}", _STREAMS, suffix=_kind)
+
+# ASGI entry point, e.g. uvicorn dkrserver:asgiapp
+asgiapp = falcon.asgi.App(middleware=[
+    RequestLog(_LOGGER),
+    MetricsMiddleware(_METRICS),
+    RequireJSON(_LOGGER, _CFG),
+    _RESPCACHE,
+    JSONTranslator(_LOGGER),
+])
+AsyncResource.routes(asgiapp, _ROUTES, _CFG)
+_ASTREAMS = AsyncDkrStreams(dkrsrvr, _CFG)
+for _kind in DkrStreams.KINDS:
+    asgiapp.add_route(f"/containers/{{name}}/{_kind}", _ASTREAMS, suffix=_kind)
 
-dkrsrvr = DkrLaunch(_LOGGER, _CFG)
-dkrimages = DkrImages(_LOGGER, _CFG)
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, simple_server.WSGIServer):
+    ''' wsgiref server handling each request on its own thread, an open stream doesn't block other requests '''
+    daemon_threads = True
 
-app.add_route('/images', dkrimages)
-app.add_route('/', dkrsrvr)
-app.add_route('/containers', dkrsrvr)
 
 if __name__ == '__main__':
-    httpd = simple_server.make_server(socket.gethostbyname(socket.getfqdn()), 8000, app)
-    httpd.serve_forever()
+    if sys.argv[1:] == ['asgi']:
+        import uvicorn
+        uvicorn.run(asgiapp, host=socket.gethostbyname(socket.getfqdn()), port=8000)
+    else:
+        httpd = simple_server.make_server(socket.gethostbyname(socket.getfqdn()), 8000, app,
+                                          server_class=ThreadingWSGIServer)
+        httpd.serve_forever()